@@ -3,16 +3,24 @@
 不需要 Redis，适合中小型部署
 """
 
+import heapq
 import time
 from typing import Any, Optional
 from functools import wraps
 
 class SimpleCache:
-    """简单的内存缓存"""
+    """简单的内存缓存（过期项定期清理，超过容量时淘汰最早过期的项）"""
     
-    def __init__(self):
+    # 最多缓存的项数
+    MAX_SIZE = 10000
+    # 两次过期清理的最短间隔（秒）
+    SWEEP_INTERVAL = 300
+    
+    def __init__(self, max_size: int = MAX_SIZE):
         self._cache = {}
         self._expires = {}
+        self._max_size = max_size
+        self._last_sweep = time.time()
     
     def get(self, key: str) -> Optional[Any]:
         """获取缓存值"""
@@ -26,8 +34,24 @@ class SimpleCache:
     
     def set(self, key: str, value: Any, ttl: int = 60):
         """设置缓存值，ttl 为过期时间（秒）"""
+        now = time.time()
         self._cache[key] = value
-        self._expires[key] = time.time() + ttl
+        self._expires[key] = now + ttl
+        if len(self._cache) > self._max_size or now - self._last_sweep > self.SWEEP_INTERVAL:
+            self._sweep(now)
+    
+    def _sweep(self, now: float):
+        """
+        清理已过期（但一直没有再被读取）的项
+        仍超过容量时淘汰最早过期的项，留出 10% 余量，避免之后每次 set 都触发清理
+        """
+        self._last_sweep = now
+        for key in [k for k, expires in self._expires.items() if expires < now]:
+            self.delete(key)
+        if len(self._cache) > self._max_size:
+            overflow = len(self._cache) - self._max_size * 9 // 10
+            for key in heapq.nsmallest(overflow, self._expires, key=self._expires.get):
+                self.delete(key)
     
     def delete(self, key: str):
         """删除缓存"""
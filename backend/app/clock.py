@@ -0,0 +1,57 @@
+"""
+请求级时间
+每个 HTTP 请求进入时取一次当前 UTC 时间，请求内的配额统计、速率限制、日志等共用，
+避免在热路径上反复调用 datetime.utcnow()
+"""
+
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Optional
+import time
+
+
+_request_now: ContextVar[Optional[datetime]] = ContextVar("request_now", default=None)
+
+
+def request_utcnow() -> datetime:
+    """
+    当前请求开始时的 UTC 时间（naive，与数据库中的时间字段一致）
+    不在请求上下文中时返回实时时间
+    """
+    now = _request_now.get()
+    return now if now is not None else datetime.utcnow()
+
+
+# 秒级 ISO 时间字符串缓存：(秒, 字符串)
+_iso_tick = (0, "")
+
+
+def utcnow_iso() -> str:
+    """
+    当前 UTC 时间的 ISO 字符串（精确到秒）
+    同一秒内复用同一个字符串，用于日志推送等只需秒级精度的展示字段
+    """
+    global _iso_tick
+    second = int(time.time())
+    if _iso_tick[0] != second:
+        # 去掉时区信息，保持与 naive UTC 时间相同的输出格式（不带 +00:00）
+        _iso_tick = (second, datetime.fromtimestamp(second, timezone.utc).replace(tzinfo=None).isoformat())
+    return _iso_tick[1]
+
+
+class RequestClockMiddleware:
+    """ASGI 中间件：为每个 HTTP 请求记录开始时间"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        token = _request_now.set(datetime.utcnow())
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _request_now.reset(token)
@@ -25,13 +25,15 @@ if is_sqlite:
         poolclass=NullPool,
     )
 else:
-    # PostgreSQL 配置
+    # PostgreSQL 配置（连接池：每个代理请求有多次数据库往返，复用连接避免重复建连）
     engine = create_async_engine(
         settings.database_url, 
         echo=False,
-        pool_size=10,
-        max_overflow=20,
+        pool_size=20,
+        max_overflow=40,
         pool_pre_ping=True,
+        pool_recycle=1800,   # 30 分钟回收，避免被服务端/中间件断开的空闲连接
+        pool_use_lifo=True,  # 优先复用最近用过的连接，空闲连接可自然过期
     )
 
 async_session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
@@ -54,7 +56,13 @@ async def init_db():
         await conn.run_sync(Base.metadata.create_all)
         
         # 数据库迁移：添加新列（如果不存在）
-        from sqlalchemy import text
+        from sqlalchemy import text, inspect
+        
+        # usage_logs.model_tier 是否由本次迁移新增（新增时才需要回填旧日志）
+        usage_log_columns = await conn.run_sync(
+            lambda sync_conn: {column["name"] for column in inspect(sync_conn).get_columns("usage_logs")}
+        )
+        backfill_model_tier = "model_tier" not in usage_log_columns
         
         if is_sqlite:
             # SQLite 迁移
@@ -75,6 +83,8 @@ async def init_db():
                 "ALTER TABLE usage_logs ADD COLUMN request_body TEXT",
                 "ALTER TABLE usage_logs ADD COLUMN client_ip VARCHAR(50)",
                 "ALTER TABLE usage_logs ADD COLUMN user_agent VARCHAR(500)",
+                "ALTER TABLE usage_logs ADD COLUMN model_tier INTEGER",
+                "ALTER TABLE credentials ADD COLUMN access_token_expires_at DATETIME",
             ]
         else:
             # PostgreSQL 迁移（使用 IF NOT EXISTS 语法）
@@ -95,6 +105,8 @@ async def init_db():
                 "ALTER TABLE usage_logs ADD COLUMN IF NOT EXISTS request_body TEXT",
                 "ALTER TABLE usage_logs ADD COLUMN IF NOT EXISTS client_ip VARCHAR(50)",
                 "ALTER TABLE usage_logs ADD COLUMN IF NOT EXISTS user_agent VARCHAR(500)",
+                "ALTER TABLE usage_logs ADD COLUMN IF NOT EXISTS model_tier INTEGER",
+                "ALTER TABLE credentials ADD COLUMN IF NOT EXISTS access_token_expires_at TIMESTAMP",
             ]
         
         for sql in migrations:
@@ -105,18 +117,54 @@ async def init_db():
                 if "duplicate column" not in str(e).lower() and "already exists" not in str(e).lower():
                     pass  # 列已存在，忽略
         
+        # 回填旧日志的配额类别（只在刚添加 model_tier 列时执行一次，避免每次启动全表扫描）
+        if backfill_model_tier:
+            try:
+                await conn.execute(text(
+                    "UPDATE usage_logs SET model_tier = CASE "
+                    "WHEN lower(model) LIKE '%gemini-3-%' THEN 2 "
+                    "WHEN lower(model) LIKE '%pro%' THEN 1 "
+                    "ELSE 0 END "
+                    "WHERE model_tier IS NULL"
+                ))
+            except Exception as e:
+                print(f"[DB Migration] ⚠️ 回填 model_tier 失败: {e}")
+        
         # 创建索引优化查询性能
         indexes = [
             "CREATE INDEX IF NOT EXISTS idx_usage_logs_created_at ON usage_logs(created_at)",
             "CREATE INDEX IF NOT EXISTS idx_usage_logs_user_id ON usage_logs(user_id)",
             "CREATE INDEX IF NOT EXISTS idx_usage_logs_status_code ON usage_logs(status_code)",
             "CREATE INDEX IF NOT EXISTS idx_usage_logs_user_created ON usage_logs(user_id, created_at)",
+            "CREATE INDEX IF NOT EXISTS idx_usage_logs_user_created_tier ON usage_logs(user_id, created_at, model_tier)",
             "CREATE INDEX IF NOT EXISTS idx_credentials_is_active ON credentials(is_active)",
             "CREATE INDEX IF NOT EXISTS idx_credentials_is_public ON credentials(is_public)",
             "CREATE INDEX IF NOT EXISTS idx_credentials_user_id ON credentials(user_id)",
             "CREATE INDEX IF NOT EXISTS idx_api_keys_user_id ON api_keys(user_id)",
         ]
         
+        # 凭证调度索引（只包含启用的凭证）：按等级/用户筛选后按 last_used_at 轮询
+        # user 对应自己凭证的查询，user_tier 对应自己凭证的 3.0 查询和凭证情况检查，
+        # public 对应公共池的 3.0 查询，public_all 对应公共池不限等级的查询
+        # 调度查询的 is_active / is_public 条件必须写成字面量（true()），部分索引才会被选用
+        # idx_credentials_dispatch 没有任何查询能用上，删除以免增加写入开销
+        indexes.append("DROP INDEX IF EXISTS idx_credentials_dispatch")
+        if is_sqlite:
+            # SQLite 升序排序时 NULL 本来就排在最前
+            indexes += [
+                "CREATE INDEX IF NOT EXISTS idx_credentials_user_dispatch ON credentials(user_id, last_used_at) WHERE is_active = 1",
+                "CREATE INDEX IF NOT EXISTS idx_credentials_user_tier_dispatch ON credentials(user_id, model_tier, last_used_at) WHERE is_active = 1",
+                "CREATE INDEX IF NOT EXISTS idx_credentials_public_dispatch ON credentials(model_tier, last_used_at) WHERE is_active = 1 AND is_public = 1",
+                "CREATE INDEX IF NOT EXISTS idx_credentials_public_all_dispatch ON credentials(last_used_at) WHERE is_active = 1 AND is_public = 1",
+            ]
+        else:
+            indexes += [
+                "CREATE INDEX IF NOT EXISTS idx_credentials_user_dispatch ON credentials(user_id, last_used_at NULLS FIRST) WHERE is_active = true",
+                "CREATE INDEX IF NOT EXISTS idx_credentials_user_tier_dispatch ON credentials(user_id, model_tier, last_used_at NULLS FIRST) WHERE is_active = true",
+                "CREATE INDEX IF NOT EXISTS idx_credentials_public_dispatch ON credentials(model_tier, last_used_at NULLS FIRST) WHERE is_active = true AND is_public = true",
+                "CREATE INDEX IF NOT EXISTS idx_credentials_public_all_dispatch ON credentials(last_used_at NULLS FIRST) WHERE is_active = true AND is_public = true",
+            ]
+        
         for sql in indexes:
             try:
                 await conn.execute(text(sql))
@@ -0,0 +1,39 @@
+"""
+日志输出
+请求路径只把日志记录放入内存队列，由后台线程写 stdout，
+避免 print(..., flush=True) 的同步写阻塞事件循环
+"""
+
+import atexit
+import logging
+import os
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+
+_log_queue = queue.Queue(-1)
+
+_stream_handler = logging.StreamHandler(sys.stdout)
+_stream_handler.setFormatter(logging.Formatter("%(message)s"))
+
+_listener = QueueListener(_log_queue, _stream_handler, respect_handler_level=True)
+
+_root_logger = logging.getLogger("catiecli")
+# 每个请求都会输出的日志（选中凭证、上游请求参数等）为 DEBUG 级别，需要排查时设置 LOG_LEVEL=DEBUG
+_root_logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+_root_logger.addHandler(QueueHandler(_log_queue))
+_root_logger.propagate = False
+
+_listener.start()
+atexit.register(_listener.stop)
+
+
+def get_logger(name: str) -> logging.Logger:
+    """
+    获取模块日志器
+    用法：
+    logger = get_logger("proxy")
+    logger.info("[Proxy] 使用凭证: %s", email)
+    """
+    return _root_logger.getChild(name)
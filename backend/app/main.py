@@ -3,12 +3,17 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
 from contextlib import asynccontextmanager
+import asyncio
 import os
 
 from app.database import init_db, async_session
 from app.models.user import User
 from app.services.auth import get_password_hash
 from app.config import settings, load_config_from_db
+from app.clock import RequestClockMiddleware
+from app.services.http_client import get_http_client, close_http_client
+from app.services.log_queue import start_log_flusher, stop_log_flusher
+from app.services.credential_pool import CredentialPool
 from app.routers import auth, proxy, admin, oauth, ws, manage
 from sqlalchemy import select
 
@@ -55,7 +60,30 @@ async def lifespan(app: FastAPI):
         
         await db.commit()
     
+    # 共享 HTTP 客户端（上游连接复用）
+    get_http_client()
+    
+    # 使用日志后台批量写入
+    start_log_flusher()
+    
+    # 凭证错误计数后台批量写入
+    error_flusher = asyncio.create_task(CredentialPool.run_error_flusher())
+    
+    # 凭证调度索引定期刷新
+    index_refresher = asyncio.create_task(CredentialPool.run_dispatch_index_refresher())
+    
     yield
+    
+    for task in (index_refresher, error_flusher):
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    await CredentialPool.wait_background_writes()
+    await CredentialPool.flush_credential_errors()
+    await stop_log_flusher()
+    await close_http_client()
 
 
 app = FastAPI(
@@ -65,7 +93,7 @@ app = FastAPI(
     lifespan=lifespan
 )
 
-# CORS
+# CORS（预检请求由中间件直接响应，不进入路由）
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -74,6 +102,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 请求级时间（同一请求内共用一次取到的当前时间）
+app.add_middleware(RequestClockMiddleware)
+
 # 注册路由
 app.include_router(auth.router)
 app.include_router(proxy.router)
@@ -61,6 +61,7 @@ class UsageLog(Base):
     api_key_id = Column(Integer, ForeignKey("api_keys.id"), nullable=True)
     credential_id = Column(Integer, ForeignKey("credentials.id", ondelete="SET NULL"), nullable=True)  # 使用的凭证
     model = Column(String(100), nullable=True)
+    model_tier = Column(Integer, nullable=True)  # 配额类别: 0=Flash, 1=Pro, 2=3.0（写入时计算，用于配额统计）
     endpoint = Column(String(200), nullable=True)
     tokens_input = Column(Integer, default=0)
     tokens_output = Column(Integer, default=0)
@@ -106,6 +107,8 @@ class Credential(Base):
     last_used_flash = Column(DateTime, nullable=True)  # Flash 模型组 CD
     last_used_pro = Column(DateTime, nullable=True)    # Pro 模型组 CD
     last_used_30 = Column(DateTime, nullable=True)     # 3.0 模型组 CD
+    # OAuth access_token（存于 api_key）的过期时间，重启后未过期的 token 可直接使用
+    access_token_expires_at = Column(DateTime, nullable=True)
     
     # 关系
     owner = relationship("User", back_populates="credentials")
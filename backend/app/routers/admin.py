@@ -176,9 +176,10 @@ async def delete_user(
     
     # 先删除用户的凭证（解除使用记录的外键引用）
     user_cred_result = await db.execute(
-        select(Credential.id).where(Credential.user_id == user_id)
+        select(Credential.id, Credential.project_id).where(Credential.user_id == user_id)
     )
-    user_cred_ids = [row[0] for row in user_cred_result.fetchall()]
+    user_creds = user_cred_result.fetchall()
+    user_cred_ids = [row.id for row in user_creds]
     if user_cred_ids:
         await db.execute(
             update(UsageLog).where(UsageLog.credential_id.in_(user_cred_ids)).values(credential_id=None)
@@ -189,6 +190,7 @@ async def delete_user(
     
     await db.delete(user)
     await db.commit()
+    CredentialPool.forget_credentials(user_creds)
     await notify_user_update()
     await notify_credential_update()
     return {"message": "删除成功（已同时删除关联凭证）"}
@@ -303,6 +305,7 @@ async def update_credential(
         credential.is_active = data.is_active
     
     await db.commit()
+    CredentialPool.invalidate_dispatch_index()
     await notify_credential_update()
     return {"message": "更新成功"}
 
@@ -325,6 +328,7 @@ async def delete_credential(
     )
     await db.delete(credential)
     await db.commit()
+    CredentialPool.forget_credentials([credential])
     await notify_credential_update()
     return {"message": "删除成功"}
 
@@ -601,6 +605,7 @@ async def delete_duplicate_credentials(
         delete(Credential).where(Credential.id.in_(ids_to_delete))
     )
     await db.commit()
+    CredentialPool.forget_credentials(c for c in credentials if c.id in ids_to_delete)
     
     return {
         "deleted_count": len(ids_to_delete),
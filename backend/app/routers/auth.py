@@ -435,7 +435,7 @@ async def upload_credentials(
             verify_msg = ""
             
             try:
-                import httpx
+                from app.services.http_client import shared_http_client
                 from app.services.credential_pool import CredentialPool
                 
                 # 创建临时凭证对象用于获取 token
@@ -449,7 +449,7 @@ async def upload_credentials(
                 
                 access_token = await CredentialPool.get_access_token(temp_cred, db)
                 if access_token:
-                    async with httpx.AsyncClient(timeout=15) as client:
+                    async with shared_http_client(timeout=15.0) as client:
                         # 使用 cloudcode-pa 端点测试（与 gcli2api 一致）
                         test_url = "https://cloudcode-pa.googleapis.com/v1internal:generateContent"
                         headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
@@ -549,6 +549,8 @@ async def upload_credentials(
         except:
             pass
     
+    from app.services.credential_pool import CredentialPool
+    CredentialPool.invalidate_dispatch_index()
     return {"uploaded_count": success_count, "total_count": len(json_files), "results": results}
 
 
@@ -557,9 +559,13 @@ async def list_my_credentials(user: User = Depends(get_current_user), db: AsyncS
     """获取我的凭证列表"""
     from datetime import datetime, timedelta
     from app.config import settings
+    from app.services.credential_pool import CredentialPool
     
     result = await db.execute(
-        select(Credential).where(Credential.user_id == user.id).order_by(Credential.created_at.desc())
+        select(Credential)
+        .options(*CredentialPool.defer_secrets())
+        .where(Credential.user_id == user.id)
+        .order_by(Credential.created_at.desc())
     )
     creds = result.scalars().all()
     
@@ -650,6 +656,8 @@ async def update_my_credential(
         cred.is_active = is_active
     
     await db.commit()
+    from app.services.credential_pool import CredentialPool
+    CredentialPool.invalidate_dispatch_index()
     return {"message": "更新成功", "is_public": cred.is_public, "is_active": cred.is_active}
 
 
@@ -687,6 +695,8 @@ async def delete_my_credential(
     )
     await db.delete(cred)
     await db.commit()
+    from app.services.credential_pool import CredentialPool
+    CredentialPool.forget_credentials([cred])
     return {"message": "删除成功"}
 
 
@@ -735,6 +745,8 @@ async def delete_my_inactive_credentials(
         print(f"[批量删除] 最终提交失败: {e}", flush=True)
         await db.rollback()
     
+    from app.services.credential_pool import CredentialPool
+    CredentialPool.forget_credentials(inactive_creds)
     print(f"[批量删除] 用户 {user.username} 删除了 {deleted_count} 个失效凭证", flush=True)
     return {"message": f"已删除 {deleted_count} 个失效凭证", "deleted_count": deleted_count}
 
@@ -776,7 +788,7 @@ async def verify_my_credential(
     db: AsyncSession = Depends(get_db)
 ):
     """验证我的凭证有效性和模型等级"""
-    import httpx
+    from app.services.http_client import shared_http_client
     from app.services.credential_pool import CredentialPool
     
     try:
@@ -835,7 +847,7 @@ async def verify_my_credential(
         supports_3 = False
         error_msg = None
         
-        async with httpx.AsyncClient(timeout=15) as client:
+        async with shared_http_client(timeout=15.0) as client:
             # 使用 cloudcode-pa 端点测试（与 gcli2api 一致）
             try:
                 test_url = "https://cloudcode-pa.googleapis.com/v1internal:generateContent"
@@ -883,6 +895,7 @@ async def verify_my_credential(
         # last_error 只存储真正的错误信息
         cred.last_error = error_msg if error_msg else None
         await db.commit()
+        CredentialPool.invalidate_dispatch_index()
         
         # 获取存储空间信息
         storage_gb = type_result.get("storage_gb") if type_result else None
@@ -1188,7 +1201,7 @@ async def discord_login_url():
 @router.get("/discord/callback")
 async def discord_callback(code: str, db: AsyncSession = Depends(get_db)):
     """Discord OAuth 回调处理"""
-    import httpx
+    from app.services.http_client import shared_http_client
     
     if not settings.discord_client_id or not settings.discord_client_secret:
         raise HTTPException(status_code=503, detail="Discord OAuth 未配置")
@@ -1203,7 +1216,7 @@ async def discord_callback(code: str, db: AsyncSession = Depends(get_db)):
         "redirect_uri": settings.discord_redirect_uri
     }
     
-    async with httpx.AsyncClient() as client:
+    async with shared_http_client(timeout=5.0) as client:
         token_resp = await client.post(token_url, data=data)
         if token_resp.status_code != 200:
             error_detail = token_resp.text[:200] if token_resp.text else "未知错误"
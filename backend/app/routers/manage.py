@@ -17,6 +17,7 @@ from app.models.user import User, Credential, UsageLog
 from app.services.auth import get_current_user, get_current_admin
 from app.services.crypto import encrypt_credential, decrypt_credential
 from app.services.websocket import notify_stats_update
+from app.services.credential_pool import CredentialPool
 from app.config import settings
 
 
@@ -57,7 +58,9 @@ async def get_credentials_status(
 ):
     """获取所有凭证的详细状态"""
     result = await db.execute(
-        select(Credential).order_by(Credential.created_at.desc())
+        select(Credential)
+        .options(*CredentialPool.defer_secrets())
+        .order_by(Credential.created_at.desc())
     )
     credentials = result.scalars().all()
     
@@ -110,12 +113,16 @@ async def batch_credential_action(
         )
     elif action == "delete":
         result = await db.execute(select(Credential).where(Credential.id.in_(ids)))
-        for cred in result.scalars().all():
+        deleted_creds = result.scalars().all()
+        for cred in deleted_creds:
             await db.delete(cred)
     else:
         raise HTTPException(status_code=400, detail="无效的操作")
     
     await db.commit()
+    CredentialPool.invalidate_dispatch_index()
+    if action == "delete":
+        CredentialPool.forget_credentials(deleted_creds)
     return {"message": f"已对 {len(ids)} 个凭证执行 {action} 操作"}
 
 
@@ -144,6 +151,7 @@ async def delete_inactive_credentials(
         await db.delete(cred)
     
     await db.commit()
+    CredentialPool.forget_credentials(inactive_creds)
     return {"message": f"已删除 {deleted_count} 个无效凭证", "deleted_count": deleted_count}
 
 
@@ -194,6 +202,7 @@ async def toggle_credential(
     
     cred.is_active = not cred.is_active
     await db.commit()
+    CredentialPool.invalidate_dispatch_index()
     
     return {"message": f"凭证已{'启用' if cred.is_active else '禁用'}", "is_active": cred.is_active}
 
@@ -215,6 +224,7 @@ async def toggle_donate(
     
     cred.is_public = not cred.is_public
     await db.commit()
+    CredentialPool.invalidate_dispatch_index()
     
     return {"message": f"凭证已{'捐赠' if cred.is_public else '取消捐赠'}", "is_public": cred.is_public}
 
@@ -238,6 +248,7 @@ async def set_credential_tier(
     
     cred.model_tier = tier
     await db.commit()
+    CredentialPool.invalidate_dispatch_index()
     
     return {"message": f"凭证等级已设为 {tier}", "model_tier": tier}
 
@@ -249,7 +260,7 @@ async def verify_credential(
     db: AsyncSession = Depends(get_db)
 ):
     """验证凭证有效性和模型等级"""
-    import httpx
+    from app.services.http_client import shared_http_client
     from app.services.credential_pool import CredentialPool
     from app.services.crypto import decrypt_credential
     
@@ -277,7 +288,7 @@ async def verify_credential(
     supports_3 = False
     error_msg = None
     
-    async with httpx.AsyncClient(timeout=15) as client:
+    async with shared_http_client(timeout=15.0) as client:
         # 使用 cloudcode-pa 端点测试（与 gcli2api 一致）
         try:
             test_url = "https://cloudcode-pa.googleapis.com/v1internal:generateContent"
@@ -325,6 +336,7 @@ async def verify_credential(
     if error_msg:
         cred.last_error = error_msg
     await db.commit()
+    CredentialPool.invalidate_dispatch_index()
     
     return {
         "is_valid": is_valid,
@@ -337,6 +349,9 @@ async def verify_credential(
 # 后台任务状态存储
 _background_tasks = {}
 
+# 批量启动/检测时分批读取凭证的每批行数（每批处理并写回后才读取下一批）
+CREDENTIAL_SCAN_BATCH = 200
+
 @router.post("/credentials/start-all")
 async def start_all_credentials(
     background_tasks: BackgroundTasks,
@@ -349,23 +364,18 @@ async def start_all_credentials(
     from app.services.crypto import encrypt_credential
     from app.database import async_session
     
-    result = await db.execute(
-        select(Credential).where(
-            Credential.credential_type == "oauth",
-            Credential.refresh_token.isnot(None)
-        )
+    # 这里只统计数量，凭证数据由后台任务分批读取（只查询需要的列，不为整个凭证池创建 ORM 对象）
+    scan_query = select(
+        Credential.id,
+        Credential.email,
+        Credential.refresh_token,
+        Credential.client_id,
+        Credential.client_secret,
+    ).where(
+        Credential.credential_type == "oauth",
+        Credential.refresh_token.isnot(None)
     )
-    creds = result.scalars().all()
-    total = len(creds)
-    
-    # 提取凭证数据（避免 session 关闭后无法访问）
-    cred_data = [{
-        "id": c.id,
-        "email": c.email,
-        "refresh_token": c.refresh_token,
-        "client_id": c.client_id,
-        "client_secret": c.client_secret,
-    } for c in creds]
+    total = await db.scalar(select(func.count()).select_from(scan_query.subquery()))
     
     task_id = f"start_{datetime.utcnow().timestamp()}"
     _background_tasks[task_id] = {"status": "running", "total": total, "success": 0, "failed": 0, "progress": 0}
@@ -393,33 +403,38 @@ async def start_all_credentials(
                     print(f"[启动凭证] ❌ {data['email']} 异常: {e}", flush=True)
                     return {"id": data["id"], "email": data["email"], "token": None}
         
-        # 并发刷新
         print(f"[启动凭证] 后台开始刷新 {total} 个凭证...", flush=True)
-        results = await asyncio.gather(*[refresh_single(d) for d in cred_data])
-        
-        # 批量更新数据库
-        async with async_session() as session:
-            for res in results:
-                if res["token"]:
-                    result = await session.execute(
-                        update(Credential)
-                        .where(Credential.id == res["id"])
-                        .values(
-                            api_key=encrypt_credential(res["token"]),
-                            is_active=True,
-                            last_error=None
+        # 分批读取凭证：每批并发刷新并写回数据库后再读取下一批，内存中只保留一批凭证
+        async with async_session() as read_session, async_session() as session:
+            stream = await read_session.stream(
+                scan_query.execution_options(yield_per=CREDENTIAL_SCAN_BATCH)
+            )
+            async for partition in stream.partitions():
+                results = await asyncio.gather(*[refresh_single(dict(row._mapping)) for row in partition])
+                
+                for res in results:
+                    if res["token"]:
+                        result = await session.execute(
+                            update(Credential)
+                            .where(Credential.id == res["id"])
+                            .values(
+                                api_key=encrypt_credential(res["token"]),
+                                is_active=True,
+                                last_error=None
+                            )
                         )
-                    )
-                    # 检查是否实际更新了行
-                    if result.rowcount > 0:
-                        success += 1
-                        print(f"[启动凭证] ✅ {res['email']}", flush=True)
+                        # 检查是否实际更新了行
+                        if result.rowcount > 0:
+                            success += 1
+                            print(f"[启动凭证] ✅ {res['email']}", flush=True)
+                        else:
+                            failed += 1
+                            print(f"[启动凭证] ⚠️ {res['email']} Token获取成功但数据库更新失败(凭证可能已被删除)", flush=True)
                     else:
                         failed += 1
-                        print(f"[启动凭证] ⚠️ {res['email']} Token获取成功但数据库更新失败(凭证可能已被删除)", flush=True)
-                else:
-                    failed += 1
-            await session.commit()
+                await session.commit()
+                _background_tasks[task_id]["progress"] = success + failed
+        CredentialPool.invalidate_dispatch_index()
         
         _background_tasks[task_id] = {"status": "done", "total": total, "success": success, "failed": failed}
         print(f"[启动凭证] 完成: 成功 {success}, 失败 {failed}", flush=True)
@@ -451,25 +466,22 @@ async def verify_all_credentials(
 ):
     """一键检测所有凭证（后台任务，立即返回）"""
     import asyncio
-    import httpx
+    from app.services.http_client import shared_http_client
     from app.services.credential_pool import CredentialPool
     from app.database import async_session
     
-    result = await db.execute(select(Credential))
-    creds = result.scalars().all()
-    total = len(creds)
-    
-    # 提取凭证数据
-    cred_data = [{
-        "id": c.id,
-        "email": c.email,
-        "refresh_token": c.refresh_token,
-        "client_id": c.client_id,
-        "client_secret": c.client_secret,
-        "project_id": c.project_id,
-        "credential_type": c.credential_type,
-        "api_key": c.api_key,
-    } for c in creds]
+    # 这里只统计数量，凭证数据由后台任务分批读取（只查询需要的列）
+    scan_query = select(
+        Credential.id,
+        Credential.email,
+        Credential.refresh_token,
+        Credential.client_id,
+        Credential.client_secret,
+        Credential.project_id,
+        Credential.credential_type,
+        Credential.api_key,
+    )
+    total = await db.scalar(select(func.count(Credential.id)))
     
     task_id = f"verify_{datetime.utcnow().timestamp()}"
     _background_tasks[task_id] = {"status": "running", "total": total, "valid": 0, "invalid": 0, "tier3": 0, "pro": 0}
@@ -504,7 +516,7 @@ async def verify_all_credentials(
                     supports_3 = False
                     account_type = "unknown"
                     
-                    async with httpx.AsyncClient(timeout=10) as client:
+                    async with shared_http_client(timeout=10.0) as client:
                         test_url = "https://cloudcode-pa.googleapis.com/v1internal:generateContent"
                         headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
                         
@@ -536,39 +548,45 @@ async def verify_all_credentials(
                     return {"id": data["id"], "email": data["email"], "is_valid": False, "supports_3": False, "account_type": "unknown"}
         
         print(f"[检测凭证] 后台开始检测 {total} 个凭证...", flush=True)
-        results = await asyncio.gather(*[verify_single(d) for d in cred_data])
-        
-        # 批量更新数据库
-        async with async_session() as session:
-            for res in results:
-                model_tier = "3" if res["supports_3"] else "2.5"
-                update_vals = {"is_active": res["is_valid"], "model_tier": model_tier}
-                if res.get("account_type") != "unknown":
-                    update_vals["account_type"] = res["account_type"]
-                if res.get("token"):
-                    from app.services.crypto import encrypt_credential
-                    update_vals["api_key"] = encrypt_credential(res["token"])
-                
-                result = await session.execute(
-                    update(Credential).where(Credential.id == res["id"]).values(**update_vals)
-                )
+        # 分批读取凭证：每批并发检测并写回数据库后再读取下一批，内存中只保留一批凭证
+        async with async_session() as read_session, async_session() as session:
+            stream = await read_session.stream(
+                scan_query.execution_options(yield_per=CREDENTIAL_SCAN_BATCH)
+            )
+            async for partition in stream.partitions():
+                results = await asyncio.gather(*[verify_single(dict(row._mapping)) for row in partition])
                 
-                # 检查是否实际更新了行
-                if result.rowcount > 0:
-                    if res["is_valid"]:
-                        valid += 1
-                        if res["supports_3"]:
-                            tier3 += 1
-                        if res["account_type"] == "pro":
-                            pro += 1
-                        print(f"[检测] ✅ {res['email']} tier={model_tier}", flush=True)
+                for res in results:
+                    model_tier = "3" if res["supports_3"] else "2.5"
+                    update_vals = {"is_active": res["is_valid"], "model_tier": model_tier}
+                    if res.get("account_type") != "unknown":
+                        update_vals["account_type"] = res["account_type"]
+                    if res.get("token"):
+                        from app.services.crypto import encrypt_credential
+                        update_vals["api_key"] = encrypt_credential(res["token"])
+                    
+                    result = await session.execute(
+                        update(Credential).where(Credential.id == res["id"]).values(**update_vals)
+                    )
+                    
+                    # 检查是否实际更新了行
+                    if result.rowcount > 0:
+                        if res["is_valid"]:
+                            valid += 1
+                            if res["supports_3"]:
+                                tier3 += 1
+                            if res["account_type"] == "pro":
+                                pro += 1
+                            print(f"[检测] ✅ {res['email']} tier={model_tier}", flush=True)
+                        else:
+                            invalid += 1
+                            print(f"[检测] ❌ {res['email']}", flush=True)
                     else:
-                        invalid += 1
-                        print(f"[检测] ❌ {res['email']}", flush=True)
-                else:
-                    print(f"[检测] ⚠️ {res['email']} 数据库更新失败(凭证可能已被删除)", flush=True)
-            
-            await session.commit()
+                        print(f"[检测] ⚠️ {res['email']} 数据库更新失败(凭证可能已被删除)", flush=True)
+                
+                await session.commit()
+                _background_tasks[task_id].update(valid=valid, invalid=invalid, tier3=tier3, pro=pro)
+        CredentialPool.invalidate_dispatch_index()
         
         _background_tasks[task_id] = {"status": "done", "total": total, "valid": valid, "invalid": invalid, "tier3": tier3, "pro": pro}
         print(f"[检测凭证] 完成: 有效 {valid}, 无效 {invalid}, 3.0 {tier3}", flush=True)
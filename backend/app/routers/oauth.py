@@ -3,7 +3,6 @@ from fastapi.responses import RedirectResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import BaseModel
 from typing import Optional
-import httpx
 import secrets
 import json
 from urllib.parse import urlencode, quote
@@ -11,7 +10,9 @@ from urllib.parse import urlencode, quote
 from app.database import get_db
 from app.models.user import User, Credential
 from app.services.auth import get_current_user, get_current_admin
+from app.services.credential_pool import CredentialPool
 from app.config import settings
+from app.services.http_client import shared_http_client
 
 router = APIRouter(prefix="/api/oauth", tags=["OAuth认证"])
 
@@ -130,7 +131,7 @@ async def oauth_callback(
         # 获取 access token (使用 Gemini CLI 官方 redirect_uri)
         redirect_uri = "http://localhost:8080"
         
-        async with httpx.AsyncClient() as client:
+        async with shared_http_client(timeout=5.0) as client:
             token_response = await client.post(
                 GOOGLE_TOKEN_URL,
                 data={
@@ -150,7 +151,7 @@ async def oauth_callback(
         refresh_token = token_data.get("refresh_token")
         
         # 获取用户信息
-        async with httpx.AsyncClient() as client:
+        async with shared_http_client(timeout=5.0) as client:
             userinfo_response = await client.get(
                 GOOGLE_USERINFO_URL,
                 headers={"Authorization": f"Bearer {access_token}"}
@@ -202,7 +203,7 @@ async def credential_from_callback_url(
         # 获取 access token (使用 Gemini CLI 官方 redirect_uri)
         redirect_uri = "http://localhost:8080"
         
-        async with httpx.AsyncClient() as client:
+        async with shared_http_client(timeout=5.0) as client:
             token_response = await client.post(
                 GOOGLE_TOKEN_URL,
                 data={
@@ -225,7 +226,7 @@ async def credential_from_callback_url(
         refresh_token = token_data.get("refresh_token")
         
         # 获取用户信息
-        async with httpx.AsyncClient() as client:
+        async with shared_http_client(timeout=5.0) as client:
             userinfo_response = await client.get(
                 GOOGLE_USERINFO_URL,
                 headers={"Authorization": f"Bearer {access_token}"}
@@ -237,7 +238,7 @@ async def credential_from_callback_url(
         # 获取用户的 Google Cloud 项目列表
         project_id = ""
         try:
-            async with httpx.AsyncClient() as client:
+            async with shared_http_client(timeout=5.0) as client:
                 projects_response = await client.get(
                     "https://cloudresourcemanager.googleapis.com/v1/projects",
                     headers={"Authorization": f"Bearer {access_token}"},
@@ -293,6 +294,8 @@ async def credential_from_callback_url(
             # 更新现有凭证而不是新增
             existing.api_key = encrypt_credential(access_token)
             existing.refresh_token = encrypt_credential(refresh_token)
+            if existing.project_id != project_id:
+                CredentialPool.forget_account_type(existing.project_id)
             existing.project_id = project_id
             credential = existing
             is_new_credential = False
@@ -316,7 +319,7 @@ async def credential_from_callback_url(
         is_valid = True
         detected_tier = "2.5"
         try:
-            async with httpx.AsyncClient(timeout=30.0) as test_client:
+            async with shared_http_client(timeout=30.0) as test_client:
                 # 用简单请求测试凭证有效性
                 test_url = "https://cloudcode-pa.googleapis.com/v1internal:generateContent"
                 test_payload = {
@@ -373,6 +376,7 @@ async def credential_from_callback_url(
             print(f"[凭证更新] 已存在凭证，不重复奖励额度", flush=True)
         
         await db.commit()
+        CredentialPool.invalidate_dispatch_index()
         
         # 如果捐赠，通知更新
         if data.is_public:
@@ -440,7 +444,7 @@ async def credential_from_callback_url_discord(
         # 获取 access token
         redirect_uri = "http://localhost:8080"
         
-        async with httpx.AsyncClient() as client:
+        async with shared_http_client(timeout=5.0) as client:
             token_response = await client.post(
                 GOOGLE_TOKEN_URL,
                 data={
@@ -463,7 +467,7 @@ async def credential_from_callback_url_discord(
         refresh_token = token_data.get("refresh_token")
         
         # 获取用户信息
-        async with httpx.AsyncClient() as client:
+        async with shared_http_client(timeout=5.0) as client:
             userinfo_response = await client.get(
                 GOOGLE_USERINFO_URL,
                 headers={"Authorization": f"Bearer {access_token}"}
@@ -475,7 +479,7 @@ async def credential_from_callback_url_discord(
         # 获取项目 ID
         project_id = ""
         try:
-            async with httpx.AsyncClient() as client:
+            async with shared_http_client(timeout=5.0) as client:
                 projects_response = await client.get(
                     "https://cloudresourcemanager.googleapis.com/v1/projects",
                     headers={"Authorization": f"Bearer {access_token}"},
@@ -520,6 +524,8 @@ async def credential_from_callback_url_discord(
             # 更新现有凭证
             existing.api_key = encrypt_credential(access_token)
             existing.refresh_token = encrypt_credential(refresh_token)
+            if existing.project_id != project_id:
+                CredentialPool.forget_account_type(existing.project_id)
             existing.project_id = project_id
             credential = existing
             is_new_credential = False
@@ -543,7 +549,7 @@ async def credential_from_callback_url_discord(
         is_valid = True
         detected_tier = "2.5"
         try:
-            async with httpx.AsyncClient(timeout=30.0) as test_client:
+            async with shared_http_client(timeout=30.0) as test_client:
                 test_url = "https://cloudcode-pa.googleapis.com/v1internal:generateContent"
                 test_response = await test_client.post(
                     test_url,
@@ -583,6 +589,7 @@ async def credential_from_callback_url_discord(
             print(f"[Discord OAuth] 用户 {user.username} 获得 {reward_quota} 额度奖励", flush=True)
         
         await db.commit()
+        CredentialPool.invalidate_dispatch_index()
         
         msg = "凭证更新成功" if not is_new_credential else "凭证添加成功"
         if not is_new_credential:
@@ -1,22 +1,59 @@
 from fastapi import APIRouter, Depends, HTTPException, Request
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import Response, StreamingResponse, ORJSONResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func, or_, and_
-from datetime import date, datetime, timedelta
-from typing import Optional
-import json
+from sqlalchemy import select, func
+from datetime import timedelta
+from typing import AsyncGenerator, Optional
 import time
+import orjson
 
 from app.database import get_db
-from app.models.user import User, UsageLog
+from app.models.user import User, UsageLog, Credential
 from app.services.auth import get_user_by_api_key
 from app.services.credential_pool import CredentialPool
 from app.services.gemini_client import GeminiClient
-from app.services.websocket import notify_log_update, notify_stats_update
+from app.services.http_client import get_http_client, read_error_body
+from app.services.log_queue import enqueue_log, pending_usage
 from app.config import settings
+from app.logger import get_logger
+from app.clock import request_utcnow, utcnow_iso
 import re
 
-router = APIRouter(tags=["API代理"])
+router = APIRouter(tags=["API代理"], default_response_class=ORJSONResponse)
+logger = get_logger("proxy")
+
+# 可重试的错误特征（404、500、503、429、连接中断等），一次扫描完成匹配
+_RETRYABLE_ERROR_RE = re.compile(
+    r"404|500|503|429|RESOURCE_EXHAUSTED|NOT_FOUND|ECONNRESET|socket hang up"
+    r"|ConnectionReset|Connection reset|ETIMEDOUT|ECONNREFUSED"
+)
+
+# SSE 响应头（所有流式响应共用）
+SSE_RESPONSE_HEADERS = {"Cache-Control": "no-cache", "Connection": "keep-alive"}
+
+# chat/completions 请求体中由代理自己处理、不透传给 GeminiClient 的字段
+_CHAT_RESERVED_KEYS = frozenset({"model", "messages", "stream"})
+
+
+# 请求体中顶层 "stream" 字段的字节特征
+_STREAM_FIELD_RE = re.compile(rb'"stream"\s*:\s*(true|false)')
+
+
+def is_stream_request(body: bytes) -> bool:
+    """
+    判断请求体是否 "stream": true
+    只扫描原始字节；出现多个 "stream" 字段等无法确定的情况才解析 JSON
+    """
+    if b'"stream"' not in body:
+        return False
+    matches = _STREAM_FIELD_RE.findall(body)
+    if len(matches) == 1:
+        return matches[0] == b"true"
+    try:
+        body_json = orjson.loads(body)
+    except orjson.JSONDecodeError:
+        return False
+    return isinstance(body_json, dict) and bool(body_json.get("stream", False))
 
 
 def extract_status_code(error_str: str, default: int = 500) -> int:
@@ -38,6 +75,75 @@ def extract_status_code(error_str: str, default: int = 500) -> int:
     return default
 
 
+def unwrap_sse_line(line: bytes) -> Optional[bytes]:
+    """
+    将内部 API 的 SSE 数据行 {"response": {...}} 转为标准 Gemini 格式
+    不是包装格式时返回 None
+    """
+    if b'"response"' not in line:
+        return None
+    try:
+        data = orjson.loads(line[6:])
+    except orjson.JSONDecodeError:
+        return None
+    if not isinstance(data, dict) or "response" not in data:
+        return None
+    standard_data = data.get("response", {})
+    if "modelVersion" in data:
+        standard_data["modelVersion"] = data["modelVersion"]
+    return b"data: " + orjson.dumps(standard_data) + b"\n\n"
+
+
+async def iter_gemini_sse(response) -> AsyncGenerator[bytes, None]:
+    """
+    转发内部 API 的 SSE 流
+    
+    根据第一个 data 行判断格式：
+    - 带 "response" 包装：逐行解包为标准 Gemini 格式
+    - 已是标准格式：剩余内容按原始字节直接转发，不再逐行解析
+    """
+    buffer = bytearray()
+    unwrap = None  # None = 尚未确定格式
+    async for chunk in response.aiter_raw():
+        if unwrap is False:
+            yield chunk
+            continue
+        
+        buffer += chunk
+        while (i := buffer.find(b"\n")) != -1:
+            line = bytes(buffer[:i]).rstrip(b"\r")
+            del buffer[:i + 1]
+            
+            if not line.startswith(b"data: "):
+                if line or unwrap is None:
+                    yield line + b"\n"
+                continue
+            
+            converted = unwrap_sse_line(line)
+            if unwrap is None:
+                unwrap = converted is not None
+                if not unwrap:
+                    # 标准格式：把已缓冲的内容原样输出，之后直接透传
+                    yield line + b"\n" + bytes(buffer)
+                    buffer.clear()
+                    break
+            yield converted if converted is not None else line + b"\n"
+    
+    if buffer:
+        rest = bytes(buffer)
+        converted = unwrap_sse_line(rest) if unwrap and rest.startswith(b"data: ") else None
+        yield converted if converted is not None else rest
+
+
+def record_usage(notify: Optional[dict] = None, **values):
+    """
+    记录一条使用日志（放入日志队列，不等待数据库提交）
+    日志写入和所用凭证的使用统计由后台任务批量完成
+    """
+    values["model_tier"] = CredentialPool.get_usage_tier(values.get("model"))
+    enqueue_log(values, notify)
+
+
 async def get_user_from_api_key(request: Request, db: AsyncSession = Depends(get_db)) -> User:
     """从请求中提取API Key并验证用户"""
     api_key = None
@@ -75,7 +181,7 @@ async def get_user_from_api_key(request: Request, db: AsyncSession = Depends(get
     
     # 检查配额
     # 配额在北京时间 15:00 (UTC 07:00) 重置
-    now = datetime.utcnow()
+    now = request_utcnow()
     reset_time_utc = now.replace(hour=7, minute=0, second=0, microsecond=0)
     if now < reset_time_utc:
         start_of_day = reset_time_utc - timedelta(days=1)
@@ -88,8 +194,6 @@ async def get_user_from_api_key(request: Request, db: AsyncSession = Depends(get
     required_tier = CredentialPool.get_required_tier(model)
     
     # 检查用户凭证情况
-    from app.models.user import Credential
-    
     # 统计用户的 2.5 和 3.0 凭证数量
     cred_25_result = await db.execute(
         select(func.count(Credential.id))
@@ -142,33 +246,33 @@ async def get_user_from_api_key(request: Request, db: AsyncSession = Depends(get
             raise HTTPException(status_code=403, detail="无 3.0 模型使用配额")
         quota_limit = user_quota_pro
         # 2.5pro和3.0共享配额，统计所有pro模型（含2.5pro和3.0）
-        model_filter = or_(UsageLog.model.like('%pro%'), UsageLog.model.like('%3%'))
+        model_tiers = [CredentialPool.USAGE_TIER_PRO, CredentialPool.USAGE_TIER_30]
         quota_name = "Pro模型(2.5pro+3.0共享)"
     elif "pro" in model.lower():
         quota_limit = user_quota_pro
         # 2.5pro和3.0共享配额
         if has_30_access:
-            model_filter = or_(UsageLog.model.like('%pro%'), UsageLog.model.like('%3%'))
+            model_tiers = [CredentialPool.USAGE_TIER_PRO, CredentialPool.USAGE_TIER_30]
             quota_name = "Pro模型(2.5pro+3.0共享)"
         else:
-            model_filter = UsageLog.model.like('%pro%')
+            model_tiers = [CredentialPool.USAGE_TIER_PRO]
             quota_name = "2.5 Pro模型"
     else:
         quota_limit = user_quota_flash
         # Flash配额：排除pro和3.0模型
-        model_filter = and_(UsageLog.model.notlike('%pro%'), UsageLog.model.notlike('%3%'))
+        model_tiers = [CredentialPool.USAGE_TIER_FLASH]
         quota_name = "Flash模型"
 
-    # 检查该类别模型的使用量
+    # 检查该类别模型的使用量（数据库中的 + 日志队列中还没写入的）
     if quota_limit > 0:
         model_usage_result = await db.execute(
             select(func.count(UsageLog.id)).where(
                 UsageLog.user_id == user.id,
                 UsageLog.created_at >= start_of_day,
-                model_filter
+                UsageLog.model_tier.in_(model_tiers)
             )
         )
-        current_usage = model_usage_result.scalar() or 0
+        current_usage = (model_usage_result.scalar() or 0) + pending_usage(user.id, start_of_day, model_tiers)
         if current_usage >= quota_limit:
             raise HTTPException(
                 status_code=429, 
@@ -182,36 +286,52 @@ async def get_user_from_api_key(request: Request, db: AsyncSession = Depends(get
             .where(UsageLog.user_id == user.id)
             .where(UsageLog.created_at >= start_of_day)
         )
-        if (total_usage_result.scalar() or 0) >= user.daily_quota:
+        total_usage = (total_usage_result.scalar() or 0) + pending_usage(user.id, start_of_day)
+        if total_usage >= user.daily_quota:
             raise HTTPException(status_code=429, detail="已达到今日总配额限制")
     
     return user
 
 
-@router.options("/v1/chat/completions")
-@router.options("/chat/completions")
-@router.options("/v1/models")
-@router.options("/models")
-async def options_handler():
-    """处理 CORS 预检请求"""
-    return JSONResponse(content={}, headers={
-        "Access-Control-Allow-Origin": "*",
-        "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
-        "Access-Control-Allow-Headers": "*",
-    })
+async def get_user_has_public_creds(user: User = Depends(get_user_from_api_key), db: AsyncSession = Depends(get_db)) -> bool:
+    """用户是否参与大锅饭（有公开的有效凭证），同一请求内只查询一次"""
+    return await CredentialPool.check_user_has_public_creds(db, user.id)
+
+
+async def get_user_has_tier3(user: User = Depends(get_user_from_api_key), db: AsyncSession = Depends(get_db)) -> bool:
+    """用户可用的凭证池中是否有 3.0 凭证，同一请求内只查询一次"""
+    return await CredentialPool.has_tier3_credentials(user, db)
+
+
+async def check_rate_limit(
+    user: User = Depends(get_user_from_api_key),
+    user_has_public: bool = Depends(get_user_has_public_creds),
+    db: AsyncSession = Depends(get_db)
+):
+    """速率限制检查 (RPM) - 管理员豁免"""
+    if user.is_admin:
+        return
+    
+    one_minute_ago = request_utcnow() - timedelta(minutes=1)
+    rpm_result = await db.execute(
+        select(func.count(UsageLog.id))
+        .where(UsageLog.user_id == user.id)
+        .where(UsageLog.created_at >= one_minute_ago)
+    )
+    current_rpm = (rpm_result.scalar() or 0) + pending_usage(user.id, one_minute_ago)
+    max_rpm = settings.contributor_rpm if user_has_public else settings.base_rpm
+    
+    if current_rpm >= max_rpm:
+        raise HTTPException(
+            status_code=429, 
+            detail=f"速率限制: {max_rpm} 次/分钟。{'上传凭证可提升至 ' + str(settings.contributor_rpm) + ' 次/分钟' if not user_has_public else ''}"
+        )
 
 
 @router.get("/v1/models")
 @router.get("/models")
-async def list_models(request: Request, user: User = Depends(get_user_from_api_key), db: AsyncSession = Depends(get_db)):
+async def list_models(request: Request, has_tier3: bool = Depends(get_user_has_tier3)):
     """列出可用模型 (OpenAI兼容)"""
-    from app.models.user import Credential
-    
-    # 检查是否有可用的 3.0 凭证
-    has_tier3_creds = await CredentialPool.has_tier3_credentials(user, db)
-    
-    has_tier3 = await CredentialPool.has_tier3_credentials(user, db)
-    
     # 基础模型 (Gemini 2.5+)
     base_models = [
         "gemini-2.5-pro",
@@ -263,11 +383,12 @@ async def list_models(request: Request, user: User = Depends(get_user_from_api_k
     return {"object": "list", "data": models}
 
 
-@router.post("/v1/chat/completions")
-@router.post("/chat/completions")
+@router.post("/v1/chat/completions", dependencies=[Depends(check_rate_limit)])
+@router.post("/chat/completions", dependencies=[Depends(check_rate_limit)])
 async def chat_completions(
     request: Request,
     user: User = Depends(get_user_from_api_key),
+    user_has_public: bool = Depends(get_user_has_public_creds),
     db: AsyncSession = Depends(get_db)
 ):
     """Chat Completions (OpenAI兼容)"""
@@ -283,7 +404,7 @@ async def chat_completions(
         raise HTTPException(status_code=400, detail="无效的JSON请求体")
     
     # 保存请求内容摘要（截断到2000字符）
-    request_body_str = json.dumps(body, ensure_ascii=False)[:2000] if body else None
+    request_body_str = orjson.dumps(body).decode()[:2000] if body else None
     
     model = body.get("model", "gemini-2.5-flash")
     messages = body.get("messages", [])
@@ -292,80 +413,63 @@ async def chat_completions(
     if not messages:
         raise HTTPException(status_code=400, detail="messages不能为空")
     
-    # 检查用户是否参与大锅饭
-    user_has_public = await CredentialPool.check_user_has_public_creds(db, user.id)
-    
-    # 速率限制检查 (RPM) - 管理员豁免
-    if not user.is_admin:
-        one_minute_ago = datetime.utcnow() - timedelta(minutes=1)
-        rpm_result = await db.execute(
-            select(func.count(UsageLog.id))
-            .where(UsageLog.user_id == user.id)
-            .where(UsageLog.created_at >= one_minute_ago)
-        )
-        current_rpm = rpm_result.scalar() or 0
-        max_rpm = settings.contributor_rpm if user_has_public else settings.base_rpm
-        
-        if current_rpm >= max_rpm:
-            raise HTTPException(
-                status_code=429, 
-                detail=f"速率限制: {max_rpm} 次/分钟。{'上传凭证可提升至 ' + str(settings.contributor_rpm) + ' 次/分钟' if not user_has_public else ''}"
-            )
+    # 透传给 GeminiClient 的其余参数（重试时复用）
+    extra_kwargs = {k: v for k, v in body.items() if k not in _CHAT_RESERVED_KEYS}
     
     # 重试逻辑：报错时切换凭证重试
     max_retries = settings.error_retry_count
     last_error = None
-    tried_credential_ids = set()
+    
+    # 一次取出本次请求的全部候选凭证（大锅饭规则 + 模型等级匹配），重试时按顺序切换
+    candidate_credentials = await CredentialPool.get_available_credentials(
+        db, 
+        user_id=user.id,
+        user_has_public_creds=user_has_public,
+        model=model,
+        limit=max_retries + 1
+    )
+    if not candidate_credentials:
+        required_tier = CredentialPool.get_required_tier(model)
+        if required_tier == "3":
+            raise HTTPException(
+                status_code=503, 
+                detail="没有可用的 Gemini 3 等级凭证。该模型需要有 Gemini 3 资格的凭证。"
+            )
+        if not user_has_public:
+            raise HTTPException(
+                status_code=503, 
+                detail="您没有可用凭证。请在凭证管理页面上传凭证，或捐赠凭证以使用公共池。"
+            )
+        raise HTTPException(status_code=503, detail="暂无可用凭证，请稍后重试")
+    remaining_credentials = iter(candidate_credentials)
     
     for retry_attempt in range(max_retries + 1):
-        # 获取凭证（大锅饭规则 + 模型等级匹配）
-        credential = await CredentialPool.get_available_credential(
-            db, 
-            user_id=user.id,
-            user_has_public_creds=user_has_public,
-            model=model,
-            exclude_ids=tried_credential_ids  # 排除已尝试过的凭证
-        )
-        if not credential:
-            if retry_attempt > 0:
-                # 已经重试过，所有凭证都失败了
-                raise HTTPException(status_code=503, detail=f"所有凭证都失败了（已重试 {retry_attempt} 次）: {last_error}")
-            required_tier = CredentialPool.get_required_tier(model)
-            if required_tier == "3":
-                raise HTTPException(
-                    status_code=503, 
-                    detail="没有可用的 Gemini 3 等级凭证。该模型需要有 Gemini 3 资格的凭证。"
-                )
-            if not user_has_public:
-                raise HTTPException(
-                    status_code=503, 
-                    detail="您没有可用凭证。请在凭证管理页面上传凭证，或捐赠凭证以使用公共池。"
-                )
-            raise HTTPException(status_code=503, detail="暂无可用凭证，请稍后重试")
-        
-        tried_credential_ids.add(credential.id)
+        # 占用下一个候选凭证（被并发请求抢先占用的凭证会被跳过）
+        credential = await CredentialPool.claim_next_credential(db, remaining_credentials, model)
+        if credential is None:
+            break
         
         # 获取 access_token（自动刷新）
         access_token = await CredentialPool.get_access_token(credential, db)
         if not access_token:
             await CredentialPool.mark_credential_error(db, credential.id, "Token 刷新失败")
             last_error = "Token 刷新失败"
-            print(f"[Proxy] ⚠️ 凭证 {credential.email} Token 刷新失败，尝试下一个凭证 ({retry_attempt + 1}/{max_retries + 1})", flush=True)
+            logger.warning("[Proxy] ⚠️ 凭证 %s Token 刷新失败，尝试下一个凭证 (%d/%d)", credential.email, retry_attempt + 1, max_retries + 1)
             continue
         
         # 获取 project_id
         project_id = credential.project_id or ""
-        print(f"[Proxy] 使用凭证: {credential.email}, project_id: {project_id}, model: {model} (尝试 {retry_attempt + 1}/{max_retries + 1})", flush=True)
+        logger.debug("[Proxy] 使用凭证: %s, project_id: %s, model: %s (尝试 %d/%d)", credential.email, project_id, model, retry_attempt + 1, max_retries + 1)
         
         if not project_id:
-            print(f"[Proxy] ⚠️ 凭证 {credential.email} 没有 project_id!", flush=True)
+            logger.warning("[Proxy] ⚠️ 凭证 %s 没有 project_id!", credential.email)
         
         client = GeminiClient(access_token, project_id)
         
         # 记录使用日志
-        async def log_usage(status_code: int = 200, cred=credential, error_msg: str = None):
+        def log_usage(status_code: int = 200, cred=credential, error_msg: str = None):
             latency = (time.time() - start_time) * 1000
-            log = UsageLog(
+            record_usage(
                 user_id=user.id,
                 credential_id=cred.id,
                 model=model,
@@ -375,25 +479,16 @@ async def chat_completions(
                 error_message=error_msg[:2000] if error_msg else None,
                 request_body=request_body_str if status_code != 200 else None,
                 client_ip=client_ip,
-                user_agent=user_agent
+                user_agent=user_agent,
+                # WebSocket 实时通知（写库后由后台任务推送）
+                notify={
+                    "username": user.username,
+                    "model": model,
+                    "status_code": status_code,
+                    "latency_ms": round(latency, 0),
+                    "created_at": utcnow_iso()
+                }
             )
-            db.add(log)
-            await db.commit()
-            
-            # 更新凭证使用次数
-            cred.total_requests = (cred.total_requests or 0) + 1
-            cred.last_used_at = datetime.utcnow()
-            await db.commit()
-            
-            # WebSocket 实时通知
-            await notify_log_update({
-                "username": user.username,
-                "model": model,
-                "status_code": status_code,
-                "latency_ms": round(latency, 0),
-                "created_at": datetime.utcnow().isoformat()
-            })
-            await notify_stats_update()
         
         # 检查是否使用假流式
         use_fake_streaming = client.is_fake_streaming(model)
@@ -402,7 +497,7 @@ async def chat_completions(
             if stream:
                 # 流式模式：使用带重试的流生成器
                 async def stream_generator_with_retry():
-                    nonlocal credential, access_token, project_id, client, tried_credential_ids, last_error
+                    nonlocal credential, access_token, project_id, client, last_error
                     
                     for stream_retry in range(max_retries + 1):
                         try:
@@ -410,18 +505,18 @@ async def chat_completions(
                                 async for chunk in client.chat_completions_fake_stream(
                                     model=model,
                                     messages=messages,
-                                    **{k: v for k, v in body.items() if k not in ["model", "messages", "stream"]}
+                                    **extra_kwargs
                                 ):
                                     yield chunk
                             else:
                                 async for chunk in client.chat_completions_stream(
                                     model=model,
                                     messages=messages,
-                                    **{k: v for k, v in body.items() if k not in ["model", "messages", "stream"]}
+                                    **extra_kwargs
                                 ):
                                     yield chunk
-                                yield "data: [DONE]\n\n"
-                            await log_usage(cred=credential)
+                                yield b"data: [DONE]\n\n"
+                            log_usage(cred=credential)
                             return  # 成功，退出
                         except Exception as e:
                             error_str = str(e)
@@ -429,47 +524,43 @@ async def chat_completions(
                             last_error = error_str
                             
                             # 检查是否应该重试（404、500、503 等错误）
-                            should_retry = any(code in error_str for code in ["404", "500", "503", "429", "RESOURCE_EXHAUSTED", "NOT_FOUND", "ECONNRESET", "socket hang up", "ConnectionReset", "Connection reset", "ETIMEDOUT", "ECONNREFUSED"])
+                            should_retry = _RETRYABLE_ERROR_RE.search(error_str) is not None
                             
                             if should_retry and stream_retry < max_retries:
-                                print(f"[Proxy] ⚠️ 流式请求失败: {error_str}，切换凭证重试 ({stream_retry + 2}/{max_retries + 1})", flush=True)
+                                logger.warning("[Proxy] ⚠️ 流式请求失败: %s，切换凭证重试 (%d/%d)", error_str, stream_retry + 2, max_retries + 1)
                                 
                                 # 获取新凭证
-                                new_credential = await CredentialPool.get_available_credential(
-                                    db, user_id=user.id, user_has_public_creds=user_has_public,
-                                    model=model, exclude_ids=tried_credential_ids
-                                )
+                                new_credential = await CredentialPool.claim_next_credential(db, remaining_credentials, model)
                                 if new_credential:
-                                    tried_credential_ids.add(new_credential.id)
                                     new_token = await CredentialPool.get_access_token(new_credential, db)
                                     if new_token:
                                         credential = new_credential
                                         access_token = new_token
                                         project_id = new_credential.project_id or ""
                                         client = GeminiClient(access_token, project_id)
-                                        print(f"[Proxy] 🔄 切换到凭证: {credential.email}", flush=True)
+                                        logger.info("[Proxy] 🔄 切换到凭证: %s", credential.email)
                                         continue
                             
                             # 无法重试，输出错误
                             status_code = extract_status_code(error_str)
-                            await log_usage(status_code, cred=credential, error_msg=error_str)
-                            yield f"data: {json.dumps({'error': f'API Error (已重试 {stream_retry + 1} 次): {error_str}'})}\n\n"
+                            log_usage(status_code, cred=credential, error_msg=error_str)
+                            yield b"data: " + orjson.dumps({'error': f'API Error (已重试 {stream_retry + 1} 次): {error_str}'}) + b"\n\n"
                             return
                 
                 return StreamingResponse(
                     stream_generator_with_retry(),
                     media_type="text/event-stream",
-                    headers={"Cache-Control": "no-cache", "Connection": "keep-alive"}
+                    headers=SSE_RESPONSE_HEADERS
                 )
             else:
                 # 非流式模式
                 result = await client.chat_completions(
                     model=model,
                     messages=messages,
-                    **{k: v for k, v in body.items() if k not in ["model", "messages", "stream"]}
+                    **extra_kwargs
                 )
-                await log_usage()
-                return JSONResponse(content=result)
+                log_usage()
+                return ORJSONResponse(content=result)
         
         except Exception as e:
             error_str = str(e)
@@ -477,14 +568,14 @@ async def chat_completions(
             last_error = error_str
             
             # 检查是否应该重试
-            should_retry = any(code in error_str for code in ["404", "500", "503", "429", "RESOURCE_EXHAUSTED", "NOT_FOUND", "ECONNRESET", "socket hang up", "ConnectionReset", "Connection reset", "ETIMEDOUT", "ECONNREFUSED"])
+            should_retry = _RETRYABLE_ERROR_RE.search(error_str) is not None
             
             if should_retry and retry_attempt < max_retries:
-                print(f"[Proxy] ⚠️ 请求失败: {error_str}，切换凭证重试 ({retry_attempt + 2}/{max_retries + 1})", flush=True)
+                logger.warning("[Proxy] ⚠️ 请求失败: %s，切换凭证重试 (%d/%d)", error_str, retry_attempt + 2, max_retries + 1)
                 continue
             
             status_code = extract_status_code(error_str)
-            await log_usage(status_code, error_msg=error_str)
+            log_usage(status_code, error_msg=error_str)
             raise HTTPException(status_code=status_code, detail=f"API调用失败 (已重试 {retry_attempt + 1} 次): {error_str}")
     
     # 所有重试都失败
@@ -493,26 +584,10 @@ async def chat_completions(
 
 # ===== Gemini 原生接口支持 =====
 
-@router.options("/v1beta/models/{model:path}:generateContent")
-@router.options("/v1/models/{model:path}:generateContent")
-@router.options("/v1beta/models/{model:path}:streamGenerateContent")
-@router.options("/v1/models/{model:path}:streamGenerateContent")
-async def gemini_options_handler(model: str):
-    """Gemini 接口 CORS 预检"""
-    return JSONResponse(content={}, headers={
-        "Access-Control-Allow-Origin": "*",
-        "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
-        "Access-Control-Allow-Headers": "*",
-    })
-
-
 @router.get("/v1beta/models")
 @router.get("/v1/v1beta/models")
-async def list_gemini_models(request: Request, user: User = Depends(get_user_from_api_key), db: AsyncSession = Depends(get_db)):
+async def list_gemini_models(request: Request, has_tier3: bool = Depends(get_user_has_tier3)):
     """Gemini 格式模型列表"""
-    # 检查是否有可用的 3.0 凭证
-    has_tier3 = await CredentialPool.has_tier3_credentials(user, db)
-    
     base_models = ["gemini-2.5-pro", "gemini-2.5-flash"]
     if has_tier3:
         base_models.append("gemini-3-pro-preview")
@@ -533,13 +608,14 @@ async def list_gemini_models(request: Request, user: User = Depends(get_user_fro
     return {"models": models}
 
 
-@router.post("/v1beta/models/{model:path}:generateContent")
-@router.post("/v1/models/{model:path}:generateContent")
-@router.post("/v1/v1beta/models/{model:path}:generateContent")
+@router.post("/v1beta/models/{model:path}:generateContent", dependencies=[Depends(check_rate_limit)])
+@router.post("/v1/models/{model:path}:generateContent", dependencies=[Depends(check_rate_limit)])
+@router.post("/v1/v1beta/models/{model:path}:generateContent", dependencies=[Depends(check_rate_limit)])
 async def gemini_generate_content(
     model: str,
     request: Request,
     user: User = Depends(get_user_from_api_key),
+    user_has_public: bool = Depends(get_user_has_public_creds),
     db: AsyncSession = Depends(get_db)
 ):
     """Gemini 原生 generateContent 接口"""
@@ -558,23 +634,6 @@ async def gemini_generate_content(
     if model.startswith("models/"):
         model = model[7:]
     
-    # 检查用户是否参与大锅饭
-    user_has_public = await CredentialPool.check_user_has_public_creds(db, user.id)
-    
-    # 速率限制 - 管理员豁免
-    if not user.is_admin:
-        one_minute_ago = datetime.utcnow() - timedelta(minutes=1)
-        rpm_result = await db.execute(
-            select(func.count(UsageLog.id))
-            .where(UsageLog.user_id == user.id)
-            .where(UsageLog.created_at >= one_minute_ago)
-        )
-        current_rpm = rpm_result.scalar() or 0
-        max_rpm = settings.contributor_rpm if user_has_public else settings.base_rpm
-        
-        if current_rpm >= max_rpm:
-            raise HTTPException(status_code=429, detail=f"速率限制: {max_rpm} 次/分钟")
-    
     # 获取凭证
     credential = await CredentialPool.get_available_credential(
         db, user_id=user.id, user_has_public_creds=user_has_public, model=model
@@ -587,20 +646,15 @@ async def gemini_generate_content(
         raise HTTPException(status_code=503, detail="凭证已失效")
     
     project_id = credential.project_id or ""
-    print(f"[Gemini API] 使用凭证: {credential.email}, project_id: {project_id}, model: {model}", flush=True)
+    logger.debug("[Gemini API] 使用凭证: %s, project_id: %s, model: %s", credential.email, project_id, model)
     
     # 记录日志
-    async def log_usage(status_code: int = 200, cd_seconds: int = None, error_msg: str = None):
+    def log_usage(status_code: int = 200, cd_seconds: int = None, error_msg: str = None):
         latency = (time.time() - start_time) * 1000
-        log = UsageLog(user_id=user.id, credential_id=credential.id, model=model, endpoint="/v1beta/generateContent", status_code=status_code, latency_ms=latency, cd_seconds=cd_seconds, error_message=error_msg[:2000] if error_msg else None)
-        db.add(log)
-        credential.total_requests = (credential.total_requests or 0) + 1
-        credential.last_used_at = datetime.utcnow()
-        await db.commit()
+        record_usage(user_id=user.id, credential_id=credential.id, model=model, endpoint="/v1beta/generateContent", status_code=status_code, latency_ms=latency, cd_seconds=cd_seconds, error_message=error_msg[:2000] if error_msg else None)
     
     # 直接转发到 Google API
     try:
-        import httpx
         url = "https://cloudcode-pa.googleapis.com/v1internal:generateContent"
         
         # 构建 payload
@@ -616,42 +670,42 @@ async def gemini_generate_content(
         
         payload = {"model": model, "project": project_id, "request": request_body}
         
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            response = await client.post(
-                url,
-                headers={"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"},
-                json=payload
-            )
-            
-            if response.status_code != 200:
-                error_text = response.text[:500]
-                print(f"[Gemini API] ❌ 错误 {response.status_code}: {error_text}", flush=True)
-                # 401/403 错误自动禁用凭证
-                if response.status_code in [401, 403]:
-                    await CredentialPool.handle_credential_failure(db, credential.id, f"API Error {response.status_code}: {error_text}")
-                    await log_usage(response.status_code, error_msg=error_text)
-                # 429 错误解析 Google 返回的 CD 时间
-                elif response.status_code == 429:
-                    cd_sec = await CredentialPool.handle_429_rate_limit(
-                        db, credential.id, model, error_text, dict(response.headers)
-                    )
-                    await log_usage(response.status_code, cd_seconds=cd_sec, error_msg=error_text)
-                else:
-                    await log_usage(response.status_code, error_msg=error_text)
-                raise HTTPException(status_code=response.status_code, detail=response.text)
-            
-            await log_usage()
-            
-            # 转换响应格式：从内部格式转为标准 Gemini API 格式
-            result = response.json()
-            if "response" in result:
-                # 内部 API 格式: {"response": {"candidates": [...]}, "modelVersion": "..."}
-                # 转为标准格式: {"candidates": [...], "modelVersion": "..."}
-                standard_result = result.get("response", {})
-                if "modelVersion" in result:
-                    standard_result["modelVersion"] = result["modelVersion"]
-                return JSONResponse(content=standard_result)
-            return JSONResponse(content=result)
+        client = get_http_client()
+        response = await client.post(
+            url,
+            headers={"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"},
+            content=orjson.dumps(payload)
+        )
+        
+        if response.status_code != 200:
+            error_text = response.text[:500]
+            logger.error("[Gemini API] ❌ 错误 %d: %s", response.status_code, error_text)
+            # 401/403 错误自动禁用凭证
+            if response.status_code in [401, 403]:
+                await CredentialPool.handle_credential_failure(db, credential.id, f"API Error {response.status_code}: {error_text}")
+                log_usage(response.status_code, error_msg=error_text)
+            # 429 错误解析 Google 返回的 CD 时间
+            elif response.status_code == 429:
+                cd_sec = await CredentialPool.handle_429_rate_limit(
+                    db, credential.id, model, error_text, dict(response.headers)
+                )
+                log_usage(response.status_code, cd_seconds=cd_sec, error_msg=error_text)
+            else:
+                log_usage(response.status_code, error_msg=error_text)
+            raise HTTPException(status_code=response.status_code, detail=response.text)
+        
+        log_usage()
+        
+        # 转换响应格式：从内部格式转为标准 Gemini API 格式
+        result = response.json()
+        if "response" in result:
+            # 内部 API 格式: {"response": {"candidates": [...]}, "modelVersion": "..."}
+            # 转为标准格式: {"candidates": [...], "modelVersion": "..."}
+            standard_result = result.get("response", {})
+            if "modelVersion" in result:
+                standard_result["modelVersion"] = result["modelVersion"]
+            return ORJSONResponse(content=standard_result)
+        return ORJSONResponse(content=result)
     
     except HTTPException:
         raise
@@ -659,17 +713,18 @@ async def gemini_generate_content(
         error_str = str(e)
         await CredentialPool.handle_credential_failure(db, credential.id, error_str)
         status_code = extract_status_code(error_str)
-        await log_usage(status_code, error_msg=error_str)
+        log_usage(status_code, error_msg=error_str)
         raise HTTPException(status_code=status_code, detail=error_str)
 
 
-@router.post("/v1beta/models/{model:path}:streamGenerateContent")
-@router.post("/v1/models/{model:path}:streamGenerateContent")
-@router.post("/v1/v1beta/models/{model:path}:streamGenerateContent")
+@router.post("/v1beta/models/{model:path}:streamGenerateContent", dependencies=[Depends(check_rate_limit)])
+@router.post("/v1/models/{model:path}:streamGenerateContent", dependencies=[Depends(check_rate_limit)])
+@router.post("/v1/v1beta/models/{model:path}:streamGenerateContent", dependencies=[Depends(check_rate_limit)])
 async def gemini_stream_generate_content(
     model: str,
     request: Request,
     user: User = Depends(get_user_from_api_key),
+    user_has_public: bool = Depends(get_user_has_public_creds),
     db: AsyncSession = Depends(get_db)
 ):
     """Gemini 原生 streamGenerateContent 接口"""
@@ -688,23 +743,6 @@ async def gemini_stream_generate_content(
     if model.startswith("models/"):
         model = model[7:]
     
-    # 检查用户是否参与大锅饭
-    user_has_public = await CredentialPool.check_user_has_public_creds(db, user.id)
-    
-    # 速率限制 - 管理员豁免
-    if not user.is_admin:
-        one_minute_ago = datetime.utcnow() - timedelta(minutes=1)
-        rpm_result = await db.execute(
-            select(func.count(UsageLog.id))
-            .where(UsageLog.user_id == user.id)
-            .where(UsageLog.created_at >= one_minute_ago)
-        )
-        current_rpm = rpm_result.scalar() or 0
-        max_rpm = settings.contributor_rpm if user_has_public else settings.base_rpm
-        
-        if current_rpm >= max_rpm:
-            raise HTTPException(status_code=429, detail=f"速率限制: {max_rpm} 次/分钟")
-    
     # 获取凭证
     credential = await CredentialPool.get_available_credential(
         db, user_id=user.id, user_has_public_creds=user_has_public, model=model
@@ -717,19 +755,14 @@ async def gemini_stream_generate_content(
         raise HTTPException(status_code=503, detail="凭证已失效")
     
     project_id = credential.project_id or ""
-    print(f"[Gemini Stream] 使用凭证: {credential.email}, project_id: {project_id}, model: {model}", flush=True)
+    logger.debug("[Gemini Stream] 使用凭证: %s, project_id: %s, model: %s", credential.email, project_id, model)
     
     # 记录日志
-    async def log_usage(status_code: int = 200, cd_seconds: int = None, error_msg: str = None):
+    def log_usage(status_code: int = 200, cd_seconds: int = None, error_msg: str = None):
         latency = (time.time() - start_time) * 1000
-        log = UsageLog(user_id=user.id, credential_id=credential.id, model=model, endpoint="/v1beta/streamGenerateContent", status_code=status_code, latency_ms=latency, cd_seconds=cd_seconds, error_message=error_msg[:2000] if error_msg else None)
-        db.add(log)
-        credential.total_requests = (credential.total_requests or 0) + 1
-        credential.last_used_at = datetime.utcnow()
-        await db.commit()
+        record_usage(user_id=user.id, credential_id=credential.id, model=model, endpoint="/v1beta/streamGenerateContent", status_code=status_code, latency_ms=latency, cd_seconds=cd_seconds, error_message=error_msg[:2000] if error_msg else None)
     
     # 流式转发
-    import httpx
     url = "https://cloudcode-pa.googleapis.com/v1internal:streamGenerateContent?alt=sse"
     
     request_body = {"contents": contents}
@@ -746,69 +779,67 @@ async def gemini_stream_generate_content(
     
     async def stream_generator():
         try:
-            async with httpx.AsyncClient(timeout=120.0) as client:
-                async with client.stream(
-                    "POST", url,
-                    headers={"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"},
-                    json=payload
-                ) as response:
-                    if response.status_code != 200:
-                        error = await response.aread()
-                        error_text = error.decode()[:500]
-                        print(f"[Gemini Stream] ❌ 错误 {response.status_code}: {error_text}", flush=True)
-                        # 401/403 错误自动禁用凭证
-                        if response.status_code in [401, 403]:
-                            await CredentialPool.handle_credential_failure(db, credential.id, f"API Error {response.status_code}: {error_text}")
-                            await log_usage(response.status_code, error_msg=error_text)
-                        # 429 错误解析 Google 返回的 CD 时间
-                        elif response.status_code == 429:
-                            cd_sec = await CredentialPool.handle_429_rate_limit(
-                                db, credential.id, model, error_text, dict(response.headers)
-                            )
-                            await log_usage(response.status_code, cd_seconds=cd_sec, error_msg=error_text)
-                        # 其他错误（500等）也要记录
-                        else:
-                            await log_usage(response.status_code, error_msg=error_text)
-                        yield f"data: {json.dumps({'error': error.decode()})}\n\n"
-                        return
-                    
-                    async for line in response.aiter_lines():
-                        if line:
-                            # 转换 SSE 数据格式
-                            if line.startswith("data: "):
-                                try:
-                                    data = json.loads(line[6:])
-                                    if "response" in data:
-                                        # 转换格式
-                                        standard_data = data.get("response", {})
-                                        if "modelVersion" in data:
-                                            standard_data["modelVersion"] = data["modelVersion"]
-                                        yield f"data: {json.dumps(standard_data)}\n\n"
-                                    else:
-                                        yield f"{line}\n"
-                                except:
-                                    yield f"{line}\n"
-                            else:
-                                yield f"{line}\n"
+            client = get_http_client()
+            async with client.stream(
+                "POST", url,
+                headers={
+                    "Authorization": f"Bearer {access_token}",
+                    "Content-Type": "application/json",
+                    "Accept-Encoding": "identity",  # 原样转发字节，不需要解压
+                },
+                content=orjson.dumps(payload)
+            ) as response:
+                if response.status_code != 200:
+                    error = await read_error_body(response)
+                    error_text = error[:500]
+                    logger.error("[Gemini Stream] ❌ 错误 %d: %s", response.status_code, error_text)
+                    # 401/403 错误自动禁用凭证
+                    if response.status_code in [401, 403]:
+                        await CredentialPool.handle_credential_failure(db, credential.id, f"API Error {response.status_code}: {error_text}")
+                        log_usage(response.status_code, error_msg=error_text)
+                    # 429 错误解析 Google 返回的 CD 时间
+                    elif response.status_code == 429:
+                        cd_sec = await CredentialPool.handle_429_rate_limit(
+                            db, credential.id, model, error_text, dict(response.headers)
+                        )
+                        log_usage(response.status_code, cd_seconds=cd_sec, error_msg=error_text)
+                    # 其他错误（500等）也要记录
+                    else:
+                        log_usage(response.status_code, error_msg=error_text)
+                    yield b"data: " + orjson.dumps({'error': error}) + b"\n\n"
+                    return
+                
+                async for chunk in iter_gemini_sse(response):
+                    yield chunk
             
-            await log_usage()
+            log_usage()
         except Exception as e:
             error_str = str(e)
             await CredentialPool.handle_credential_failure(db, credential.id, error_str)
             status_code = extract_status_code(error_str)
-            await log_usage(status_code, error_msg=error_str)
-            yield f"data: {json.dumps({'error': error_str})}\n\n"
+            log_usage(status_code, error_msg=error_str)
+            yield b"data: " + orjson.dumps({'error': error_str}) + b"\n\n"
     
     return StreamingResponse(
         stream_generator(),
         media_type="text/event-stream",
-        headers={"Cache-Control": "no-cache", "Connection": "keep-alive"}
+        headers=SSE_RESPONSE_HEADERS
     )
 
 
 # ===== OpenAI 原生反代 =====
 
-@router.api_route("/openai/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH"])
+async def require_openai_api_key():
+    """OpenAI 反代配置检查，排在速率限制之前（未配置时不查询、不占用用户的速率额度）"""
+    if not settings.openai_api_key:
+        raise HTTPException(status_code=503, detail="未配置 OpenAI API Key，无法使用 OpenAI 反代")
+
+
+@router.api_route(
+    "/openai/{path:path}",
+    methods=["GET", "POST", "PUT", "DELETE", "PATCH"],
+    dependencies=[Depends(require_openai_api_key), Depends(check_rate_limit)]
+)
 async def openai_proxy(
     path: str,
     request: Request,
@@ -816,28 +847,8 @@ async def openai_proxy(
     db: AsyncSession = Depends(get_db)
 ):
     """OpenAI 原生 API 反代 - 直接转发到 OpenAI"""
-    import httpx
-    
-    if not settings.openai_api_key:
-        raise HTTPException(status_code=503, detail="未配置 OpenAI API Key，无法使用 OpenAI 反代")
-    
     start_time = time.time()
     
-    # 检查速率限制 - 管理员豁免
-    user_has_public = await CredentialPool.check_user_has_public_creds(db, user.id)
-    if not user.is_admin:
-        one_minute_ago = datetime.utcnow() - timedelta(minutes=1)
-        rpm_result = await db.execute(
-            select(func.count(UsageLog.id))
-            .where(UsageLog.user_id == user.id)
-            .where(UsageLog.created_at >= one_minute_ago)
-        )
-        current_rpm = rpm_result.scalar() or 0
-        max_rpm = settings.contributor_rpm if user_has_public else settings.base_rpm
-        
-        if current_rpm >= max_rpm:
-            raise HTTPException(status_code=429, detail=f"速率限制: {max_rpm} 次/分钟")
-    
     # 构建目标 URL
     target_url = f"{settings.openai_api_base}/{path}"
     if request.query_params:
@@ -856,91 +867,83 @@ async def openai_proxy(
     headers.pop("Host", None)
     
     # 记录日志
-    async def log_usage(status_code: int = 200, error_msg: str = None):
+    def log_usage(status_code: int = 200, error_msg: str = None):
         latency = (time.time() - start_time) * 1000
-        log = UsageLog(
+        record_usage(
             user_id=user.id,
             credential_id=None,
             model="openai",
             endpoint=f"/openai/{path}",
             status_code=status_code,
             latency_ms=latency,
-            error_message=error_msg[:2000] if error_msg else None
+            error_message=error_msg[:2000] if error_msg else None,
+            notify={
+                "username": user.username,
+                "model": "openai",
+                "status_code": status_code,
+                "latency_ms": round(latency, 0),
+                "created_at": utcnow_iso()
+            }
         )
-        db.add(log)
-        await db.commit()
-        await notify_log_update({
-            "username": user.username,
-            "model": "openai",
-            "status_code": status_code,
-            "latency_ms": round(latency, 0),
-            "created_at": datetime.utcnow().isoformat()
-        })
-        await notify_stats_update()
     
-    # 判断是否是流式请求
-    is_stream = False
-    if body:
-        try:
-            body_json = json.loads(body)
-            is_stream = body_json.get("stream", False)
-        except:
-            pass
+    # 判断是否是流式请求（先扫描原始字节，只有无法确定时才解析 JSON）
+    is_stream = is_stream_request(body) if body else False
     
-    print(f"[OpenAI Proxy] {request.method} {target_url}, stream={is_stream}", flush=True)
+    logger.debug("[OpenAI Proxy] %s %s, stream=%s", request.method, target_url, is_stream)
     
     try:
         if is_stream:
             # 流式响应
             async def stream_generator():
                 try:
-                    async with httpx.AsyncClient(timeout=120.0) as client:
-                        async with client.stream(
-                            request.method, target_url,
-                            headers=headers,
-                            content=body
-                        ) as response:
-                            if response.status_code != 200:
-                                error = await response.aread()
-                                await log_usage(response.status_code, error_msg=error.decode()[:500])
-                                yield f"data: {json.dumps({'error': error.decode()})}\n\n"
-                                return
-                            
-                            async for line in response.aiter_lines():
-                                if line:
-                                    yield f"{line}\n"
+                    client = get_http_client()
+                    async with client.stream(
+                        request.method, target_url,
+                        headers=headers,
+                        content=body
+                    ) as response:
+                        if response.status_code != 200:
+                            error = await read_error_body(response)
+                            log_usage(response.status_code, error_msg=error[:500])
+                            yield b"data: " + orjson.dumps({'error': error}) + b"\n\n"
+                            return
+                        
+                        # 原样转发上游字节（已按 Content-Encoding 解压），不逐行解码再编码
+                        async for chunk in response.aiter_bytes():
+                            yield chunk
                     
-                    await log_usage()
+                    log_usage()
                 except Exception as e:
                     error_str = str(e)
                     status_code = extract_status_code(error_str)
-                    await log_usage(status_code, error_msg=error_str)
-                    yield f"data: {json.dumps({'error': error_str})}\n\n"
+                    log_usage(status_code, error_msg=error_str)
+                    yield b"data: " + orjson.dumps({'error': error_str}) + b"\n\n"
             
             return StreamingResponse(
                 stream_generator(),
                 media_type="text/event-stream",
-                headers={"Cache-Control": "no-cache", "Connection": "keep-alive"}
+                headers=SSE_RESPONSE_HEADERS
             )
         else:
             # 非流式响应
-            async with httpx.AsyncClient(timeout=120.0) as client:
-                response = await client.request(
-                    request.method, target_url,
-                    headers=headers,
-                    content=body
-                )
-                
-                await log_usage(response.status_code)
-                
-                # 返回响应
-                return JSONResponse(
-                    content=response.json() if response.headers.get("content-type", "").startswith("application/json") else {"text": response.text},
-                    status_code=response.status_code
-                )
+            client = get_http_client()
+            response = await client.request(
+                request.method, target_url,
+                headers=headers,
+                content=body
+            )
+            
+            log_usage(response.status_code)
+            
+            # 原样返回响应内容，不解析再序列化
+            return Response(
+                content=response.content,
+                status_code=response.status_code,
+                media_type=response.headers.get("content-type")
+            )
     
     except Exception as e:
         error_str = str(e)
         status_code = extract_status_code(error_str)
-        await log_usage(status_code, error_msg=error_str)
+        log_usage(status_code, error_msg=error_str)
         raise HTTPException(status_code=status_code, detail=f"OpenAI API 请求失败: {error_str}")
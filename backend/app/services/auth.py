@@ -10,6 +10,9 @@ from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from app.config import settings
 from app.database import get_db
 from app.models.user import User, APIKey
+from app.logger import get_logger
+
+logger = get_logger("auth")
 
 security = HTTPBearer(auto_error=False)
 
@@ -63,7 +66,7 @@ async def get_current_user(
 ) -> User:
     """获取当前用户 (JWT认证)"""
     if not credentials:
-        print("JWT认证失败: 未提供认证信息", flush=True)
+        logger.warning("JWT认证失败: 未提供认证信息")
         raise HTTPException(status_code=401, detail="Unauthorized")
     
     token = credentials.credentials
@@ -1,11 +1,81 @@
-from typing import Optional
-from datetime import datetime, timedelta
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+from datetime import datetime, timedelta, timezone
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, update, or_
+from sqlalchemy.orm import defer
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy import select, update, func, case, bindparam, exists, inspect, or_, true
+from app.database import async_session
+from app.cache import cache, CACHE_KEYS
 from app.models.user import Credential
-from app.services.crypto import decrypt_credential, encrypt_credential
+from app.services.crypto import decrypt_credential, decrypt_credentials, encrypt_credential
 from app.config import settings
-import httpx
+from app.services.http_client import get_http_client
+from app.logger import get_logger
+from functools import lru_cache
+from urllib.parse import urlencode
+import asyncio
+import time
+
+
+logger = get_logger("credential_pool")
+
+
+@lru_cache(maxsize=512)
+def _classify_model(model: Optional[str]) -> Tuple[str, str, int]:
+    """
+    根据模型名一次算出 (需要的凭证等级, CD 模型组, 配额类别)
+    模型名种类很少，结果缓存，调度和记录日志时不再重复转小写和子串查找
+    """
+    if not model:
+        return "2.5", "flash", CredentialPool.USAGE_TIER_FLASH
+    model_lower = model.lower()
+    # gemini-3-xxx 模型需要 3 等级凭证（"/gemini-3-" 也包含 "gemini-3-"）
+    if "gemini-3-" in model_lower:
+        return "3", "30", CredentialPool.USAGE_TIER_30
+    # Pro 模型
+    if "pro" in model_lower:
+        return "2.5", "pro", CredentialPool.USAGE_TIER_PRO
+    # 默认 Flash
+    return "2.5", "flash", CredentialPool.USAGE_TIER_FLASH
+
+
+OAUTH_TOKEN_URL = "https://oauth2.googleapis.com/token"
+FORM_HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
+
+
+@lru_cache(maxsize=1024)
+def _refresh_form_body(client_id: str, client_secret: str, refresh_token: str) -> bytes:
+    """刷新 token 的表单请求体（同一凭证的字段不变，编码结果缓存）"""
+    return urlencode({
+        "client_id": client_id,
+        "client_secret": client_secret,
+        "refresh_token": refresh_token,
+        "grant_type": "refresh_token"
+    }).encode()
+
+
+# 凭证池模式规则：(模式, 需要的凭证等级) → 用户能否使用公共池
+# True/False 为固定结果，"has_tier3" / "has_public" 表示由用户是否有 3.0 凭证 / 公开凭证决定
+# - private: 只能用自己的凭证
+# - tier3_shared: 请求 3.0 模型需要自己有 3.0 凭证才能用公共 3.0 池，2.5 模型所有用户都可用公共凭证
+# - full_shared（大锅饭）: 有公开凭证（有贡献）的用户才能用公共池
+_SHARED_POOL_RULES = {
+    ("private", "3"): False,
+    ("private", "2.5"): False,
+    ("tier3_shared", "3"): "has_tier3",
+    ("tier3_shared", "2.5"): True,
+    ("full_shared", "3"): "has_public",
+    ("full_shared", "2.5"): "has_public",
+}
+
+
+def _shared_pool_rule(pool_mode: str, required_tier: str):
+    """查询公共池规则，未知模式按 full_shared 处理"""
+    rule = _SHARED_POOL_RULES.get((pool_mode, required_tier))
+    if rule is None:
+        rule = _SHARED_POOL_RULES[("full_shared", required_tier)]
+    return rule
 
 
 class CredentialPool:
@@ -14,29 +84,28 @@ class CredentialPool:
     @staticmethod
     def get_required_tier(model: str) -> str:
         """根据模型名确定需要的凭证等级"""
-        model_lower = model.lower()
-        # gemini-3-xxx 模型需要 3 等级凭证
-        if "gemini-3-" in model_lower or "/gemini-3-" in model_lower:
-            return "3"
-        return "2.5"
-    
+        return _classify_model(model)[0]
+
+    # 使用日志的配额类别（UsageLog.model_tier）
+    USAGE_TIER_FLASH = 0
+    USAGE_TIER_PRO = 1
+    USAGE_TIER_30 = 2
+
+    @staticmethod
+    def get_usage_tier(model: str) -> int:
+        """
+        根据模型名确定配额类别（写入 UsageLog.model_tier）
+        返回: 0=Flash, 1=Pro, 2=3.0
+        """
+        return _classify_model(model)[2]
+
     @staticmethod
     def get_model_group(model: str) -> str:
         """
         根据模型名确定模型组（用于 CD 机制）
         返回: "flash", "pro", "30"
         """
-        if not model:
-            return "flash"
-        model_lower = model.lower()
-        # 3.0 模型
-        if "gemini-3-" in model_lower or "/gemini-3-" in model_lower:
-            return "30"
-        # Pro 模型
-        if "pro" in model_lower:
-            return "pro"
-        # 默认 Flash
-        return "flash"
+        return _classify_model(model)[1]
     
     @staticmethod
     def get_cd_seconds(model_group: str) -> int:
@@ -48,6 +117,16 @@ class CredentialPool:
         else:
             return settings.cd_flash
     
+    @staticmethod
+    def get_last_used_column(model_group: str):
+        """获取模型组对应的最后使用时间字段（CD 计算依据）"""
+        if model_group == "30":
+            return Credential.last_used_30
+        elif model_group == "pro":
+            return Credential.last_used_pro
+        else:
+            return Credential.last_used_flash
+    
     @staticmethod
     def is_credential_in_cd(credential: Credential, model_group: str) -> bool:
         """检查凭证在指定模型组是否处于 CD 中"""
@@ -56,65 +135,86 @@ class CredentialPool:
             return False
         
         # 获取对应模型组的最后使用时间
-        if model_group == "30":
-            last_used = credential.last_used_30
-        elif model_group == "pro":
-            last_used = credential.last_used_pro
-        else:
-            last_used = credential.last_used_flash
-        
+        last_used = getattr(credential, CredentialPool.get_last_used_column(model_group).key)
         if not last_used:
             return False
         
-        cd_end_time = last_used + timedelta(seconds=cd_seconds)
-        return datetime.utcnow() < cd_end_time
+        # 换算成时间戳直接比较秒数（数据库中是 naive UTC 时间）
+        return time.time() - last_used.replace(tzinfo=timezone.utc).timestamp() < cd_seconds
+    
+    # 用户凭证情况检查（是否有 3.0 / 公开凭证）的缓存时间（秒）
+    CHECK_CACHE_TTL = 10
     
     @staticmethod
-    async def check_user_has_tier3_creds(db: AsyncSession, user_id: int) -> bool:
-        """检查用户是否有 3.0 等级的凭证"""
+    async def get_user_credential_flags(db: AsyncSession, user_id: int) -> Tuple[bool, bool]:
+        """
+        一次查询得到用户的凭证情况 (是否有 3.0 凭证, 是否有公开凭证)
+        两个 EXISTS 在同一条语句中执行，结果一起缓存 CHECK_CACHE_TTL 秒
+        """
+        key = f"{CACHE_KEYS['creds']}flags:{user_id}"
+        cached_result = cache.get(key)
+        if cached_result is not None:
+            return cached_result
+        
+        own_active = (Credential.user_id == user_id, Credential.is_active == true())
         result = await db.execute(
-            select(Credential)
-            .where(Credential.user_id == user_id)
-            .where(Credential.model_tier == "3")
-            .where(Credential.is_active == True)
-            .limit(1)
+            select(
+                exists().where(*own_active, Credential.model_tier == "3").label("has_tier3"),
+                exists().where(*own_active, Credential.is_public == true()).label("has_public")
+            )
         )
-        return result.scalar_one_or_none() is not None
+        row = result.one()
+        flags = (bool(row.has_tier3), bool(row.has_public))
+        cache.set(key, flags, ttl=CredentialPool.CHECK_CACHE_TTL)
+        return flags
+    
+    @staticmethod
+    async def check_user_has_tier3_creds(db: AsyncSession, user_id: int) -> bool:
+        """检查用户是否有 3.0 等级的凭证"""
+        has_tier3, _ = await CredentialPool.get_user_credential_flags(db, user_id)
+        return has_tier3
+    
+    @staticmethod
+    async def _check_user_has_tier3_creds_detached(user_id: int) -> bool:
+        """用独立会话执行 check_user_has_tier3_creds，可与调用方会话上的查询并发（缓存命中时不会建立连接）"""
+        async with async_session() as db:
+            return await CredentialPool.check_user_has_tier3_creds(db, user_id)
     
     @staticmethod
     async def has_tier3_credentials(user, db: AsyncSession) -> bool:
-        """检查用户可用的凭证池中是否有 3.0 凭证（用于模型列表显示）"""
+        """
+        检查用户可用的凭证池中是否有 3.0 凭证（用于模型列表显示）
+        用户自己的凭证情况和公共 3.0 池在同一条语句中查询
+        """
         pool_mode = settings.credential_pool_mode
-        query = select(Credential).where(
-            Credential.is_active == True,
-            Credential.model_tier == "3"
-        ).limit(1)
-        
-        if pool_mode == "private":
-            # 私有模式：只检查自己的凭证
-            query = query.where(Credential.user_id == user.id)
-        
-        elif pool_mode == "tier3_shared":
-            # 3.0共享模式：有3.0凭证的用户可用公共3.0池
-            user_has_tier3 = await CredentialPool.check_user_has_tier3_creds(db, user.id)
-            if user_has_tier3:
-                query = query.where(
-                    or_(Credential.is_public == True, Credential.user_id == user.id)
-                )
-            else:
-                query = query.where(Credential.user_id == user.id)
-        
-        else:  # full_shared (大锅饭模式)
-            user_has_public = await CredentialPool.check_user_has_public_creds(db, user.id)
-            if user_has_public:
-                query = query.where(
-                    or_(Credential.is_public == True, Credential.user_id == user.id)
-                )
-            else:
-                query = query.where(Credential.user_id == user.id)
+        own_active = (Credential.user_id == user.id, Credential.is_active == true())
+        result = await db.execute(
+            select(
+                exists().where(*own_active, Credential.model_tier == "3").label("has_tier3"),
+                exists().where(*own_active, Credential.is_public == true()).label("has_public"),
+                exists().where(
+                    Credential.is_active == true(),
+                    Credential.model_tier == "3",
+                    Credential.is_public == true()
+                ).label("pool_has_tier3")
+            )
+        )
+        row = result.one()
+        user_has_tier3, user_has_public = bool(row.has_tier3), bool(row.has_public)
+        # 顺便刷新用户凭证情况缓存
+        cache.set(
+            f"{CACHE_KEYS['creds']}flags:{user.id}",
+            (user_has_tier3, user_has_public),
+            ttl=CredentialPool.CHECK_CACHE_TTL
+        )
         
-        result = await db.execute(query)
-        return result.scalar_one_or_none() is not None
+        if user_has_tier3:
+            return True
+        # 自己没有 3.0 凭证：看能否使用公共 3.0 池
+        rule = _shared_pool_rule(pool_mode, "3")
+        flags = {"has_tier3": user_has_tier3, "has_public": user_has_public}
+        shared_pool = flags[rule] if isinstance(rule, str) else rule
+        return shared_pool and bool(row.pool_has_tier3)
     
     @staticmethod
     async def get_available_credential(
@@ -125,7 +225,116 @@ class CredentialPool:
         exclude_ids: set = None
     ) -> Optional[Credential]:
         """
-        获取一个可用的凭证 (根据模式 + 轮询策略 + 模型等级匹配)
+        获取一个可用的凭证，并记录本次使用
+        
+        exclude_ids: 排除的凭证ID集合（用于重试时跳过已失败的凭证）
+        """
+        credentials = await CredentialPool.get_available_credentials(
+            db, user_id=user_id, user_has_public_creds=user_has_public_creds,
+            model=model, exclude_ids=exclude_ids, limit=CredentialPool.CLAIM_CANDIDATES
+        )
+        return await CredentialPool.claim_next_credential(db, iter(credentials), model)
+    
+    # 调度索引：各范围内可调度（启用且有 project_id）的凭证数量
+    # {("user", user_id, 等级): 数量, ("public", 等级): 数量}，None 表示未就绪或已失效
+    # 只用于跳过必然查不到凭证的查询，具体选哪个凭证仍由数据库排序决定
+    _dispatch_index: Optional[Dict[tuple, int]] = None
+    # 失效代数：每次失效加一，刷新期间发生过失效则丢弃本次（可能已过时的）统计结果
+    _dispatch_index_generation = 0
+    DISPATCH_INDEX_REFRESH_INTERVAL = 10  # 秒
+    
+    @staticmethod
+    async def refresh_dispatch_index():
+        """重新统计各范围的可调度凭证数量"""
+        generation = CredentialPool._dispatch_index_generation
+        async with async_session() as db:
+            result = await db.execute(
+                select(Credential.user_id, Credential.model_tier, Credential.is_public, func.count())
+                .where(
+                    Credential.is_active == true(),
+                    Credential.project_id != None,
+                    Credential.project_id != ""
+                )
+                .group_by(Credential.user_id, Credential.model_tier, Credential.is_public)
+            )
+            rows = result.all()
+        
+        index: Dict[tuple, int] = defaultdict(int)
+        for user_id, model_tier, is_public, count in rows:
+            tier = "3" if model_tier == "3" else "2.5"
+            index[("user", user_id, tier)] += count
+            if is_public:
+                index[("public", tier)] += count
+        if generation != CredentialPool._dispatch_index_generation:
+            # 统计查询期间有凭证变更提交，结果可能不包含该变更，等下次刷新
+            return
+        CredentialPool._dispatch_index = dict(index)
+    
+    @staticmethod
+    def invalidate_dispatch_index():
+        """
+        凭证的归属/等级/启用/公开状态变化提交后调用，在下次刷新前不再跳过查询
+        同时使进行中的刷新作废，避免其用变更前的统计覆盖
+        新增或启用凭证的路径必须调用；只减少可用凭证的变更（删除、出错禁用）
+        最多多执行一次查不到结果的查询，可以等待定期刷新
+        """
+        CredentialPool._dispatch_index_generation += 1
+        CredentialPool._dispatch_index = None
+    
+    @staticmethod
+    def may_have_credentials(scope: tuple, required_tier: str) -> bool:
+        """
+        根据调度索引判断范围内是否可能有可用凭证
+        scope: ("user", user_id) 或 ("public",)；索引未就绪时总是返回 True
+        """
+        index = CredentialPool._dispatch_index
+        if index is None:
+            return True
+        if required_tier == "3":
+            return index.get(scope + ("3",), 0) > 0
+        return index.get(scope + ("3",), 0) + index.get(scope + ("2.5",), 0) > 0
+    
+    @staticmethod
+    async def run_dispatch_index_refresher():
+        """后台任务：定期刷新调度索引"""
+        while True:
+            try:
+                await CredentialPool.refresh_dispatch_index()
+            except Exception as e:
+                CredentialPool.invalidate_dispatch_index()
+                logger.error("[调度索引] 刷新失败: %s", e)
+            await asyncio.sleep(CredentialPool.DISPATCH_INDEX_REFRESH_INTERVAL)
+    
+    # 加密字段（列表类查询不需要加载）
+    SECRET_COLUMNS = (
+        Credential.api_key,
+        Credential.refresh_token,
+        Credential.client_id,
+        Credential.client_secret,
+    )
+    # 调度查询中延迟加载的字段
+    DISPATCH_DEFERRED_COLUMNS = SECRET_COLUMNS + (Credential.last_error,)
+    
+    @staticmethod
+    def defer_secrets(*keep: str) -> list:
+        """
+        列表类查询的加载选项：不加载加密字段
+        keep: 仍需加载的字段名（如 "api_key"）
+        """
+        return [defer(column) for column in CredentialPool.SECRET_COLUMNS if column.key not in keep]
+    
+    @staticmethod
+    async def get_available_credentials(
+        db: AsyncSession, 
+        user_id: int = None,
+        user_has_public_creds: bool = False,
+        model: str = None,
+        exclude_ids: set = None,
+        limit: int = 1
+    ) -> List[Credential]:
+        """
+        获取按优先级排序的可用凭证列表 (根据模式 + 轮询策略 + 模型等级匹配)
+        一次取出重试所需的全部候选凭证，调用方通过 claim_next_credential 按顺序占用
         
         模式:
         - private: 只能用自己的凭证
@@ -136,10 +345,17 @@ class CredentialPool:
         - 3.0 模型只能用 3.0 等级的凭证
         - 2.5 模型可以用任何等级的凭证
         
-        exclude_ids: 排除的凭证ID集合（用于重试时跳过已失败的凭证）
+        排序: 不在 CD 中的凭证优先（最久未使用的在前），其次是 CD 中的凭证
+        limit: 最多返回的凭证数量
+        exclude_ids: 排除的凭证ID集合
         """
         pool_mode = settings.credential_pool_mode
-        query = select(Credential).where(Credential.is_active == True)
+        # 加密凭证和错误信息等大字段不随调度查询加载，选中后由 get_access_token 按需读取
+        query = (
+            select(Credential)
+            .options(*(defer(column) for column in CredentialPool.DISPATCH_DEFERRED_COLUMNS))
+            .where(Credential.is_active == true())
+        )
         
         # 排除没有 project_id 的凭证（没有 project_id 无法调用 API）
         query = query.where(Credential.project_id != None, Credential.project_id != "")
@@ -148,119 +364,209 @@ class CredentialPool:
         if exclude_ids:
             query = query.where(~Credential.id.in_(exclude_ids))
         
-        # 根据模型确定需要的凭证等级
-        required_tier = CredentialPool.get_required_tier(model) if model else "2.5"
+        # 根据模型确定需要的凭证等级和 CD 模型组
+        required_tier, model_group, _ = _classify_model(model)
         
         if required_tier == "3":
             # gemini-3 模型只能用 3 等级凭证
             query = query.where(Credential.model_tier == "3")
         # 2.5 模型可以用任何等级凭证（不添加额外筛选）
         
-        # 根据模式决定凭证访问规则
-        if pool_mode == "private":
-            # 私有模式：只能用自己的凭证
-            query = query.where(Credential.user_id == user_id)
-        
-        elif pool_mode == "tier3_shared":
-            # 3.0共享模式：
-            # - 请求3.0模型：需要有3.0凭证才能用公共3.0池
-            # - 请求2.5模型：所有用户都可以用公共2.5凭证
-            user_has_tier3 = await CredentialPool.check_user_has_tier3_creds(db, user_id)
-            
-            if required_tier == "3":
-                # 请求3.0模型
-                if user_has_tier3:
-                    # 用户有3.0凭证 → 可用公共3.0池
-                    query = query.where(
-                        or_(
-                            Credential.is_public == True,
-                            Credential.user_id == user_id
-                        )
-                    )
-                else:
-                    # 用户没有3.0凭证 → 只能用自己的凭证
-                    query = query.where(Credential.user_id == user_id)
-            else:
-                # 请求2.5模型 → 所有用户都可以用公共凭证
-                query = query.where(
-                    or_(
-                        Credential.is_public == True,
-                        Credential.user_id == user_id
-                    )
-                )
-        
-        else:  # full_shared (大锅饭模式)
-            if user_has_public_creds:
-                # 用户有贡献，可以用所有公共凭证 + 自己的私有凭证
-                query = query.where(
-                    or_(
-                        Credential.is_public == True,
-                        Credential.user_id == user_id
-                    )
-                )
-            else:
-                # 用户没有贡献，只能用自己的凭证
-                query = query.where(Credential.user_id == user_id)
-        
-        # 确定模型组（用于 CD 筛选）
-        model_group = CredentialPool.get_model_group(model) if model else "flash"
+        # 模型组的 CD 时间（用于 CD 筛选）
         cd_seconds = CredentialPool.get_cd_seconds(model_group)
         
-        result = await db.execute(
-            query.order_by(Credential.last_used_at.asc().nullsfirst())
-        )
-        credentials = result.scalars().all()
+        # 排序：最久未使用的优先，在数据库中排序并只取需要的条数，不加载全部凭证
+        # CD 条件放在 WHERE 中（可以按索引顺序扫描并在取满后停止），CD 中的凭证只在不够时补查
+        query = query.order_by(Credential.last_used_at.asc().nullsfirst())
+        if cd_seconds > 0:
+            cd_start = datetime.utcnow() - timedelta(seconds=cd_seconds)
+            last_used_column = CredentialPool.get_last_used_column(model_group)
+            cd_filter = (
+                or_(last_used_column <= cd_start, last_used_column.is_(None)),
+                last_used_column > cd_start,
+            )
+        else:
+            cd_filter = None
         
-        if not credentials:
-            return None
+        # 根据模式决定凭证访问规则（见 _SHARED_POOL_RULES）
+        # shared_pool: 可用范围是否为「公共凭证 + 自己的凭证」
+        # 不用 OR 条件，而是两部分分别走索引查询后合并
+        rule = _shared_pool_rule(pool_mode, required_tier)
+        tier3_check = None
+        if rule == "has_tier3":
+            # 检查与下面自己凭证的查询互不依赖，用独立会话并发执行
+            tier3_check = asyncio.create_task(CredentialPool._check_user_has_tier3_creds_detached(user_id))
+            shared_pool = False
+        elif rule == "has_public":
+            shared_pool = user_has_public_creds
+        else:
+            shared_pool = rule
         
-        # 筛选不在 CD 中的凭证
-        available_credentials = [
-            c for c in credentials 
-            if not CredentialPool.is_credential_in_cd(c, model_group)
-        ]
+        # 调度索引确认没有可用凭证的范围直接跳过查询
+        # rows: [(凭证, 是否在 CD 中)]
+        rows = []
+        try:
+            if CredentialPool.may_have_credentials(("user", user_id), required_tier):
+                rows = await CredentialPool._fetch_dispatch_rows(
+                    db, query.where(Credential.user_id == user_id), cd_filter, limit
+                )
+            if tier3_check is not None:
+                shared_pool = await tier3_check
+        finally:
+            if tier3_check is not None and not tier3_check.done():
+                tier3_check.cancel()
+        
+        if shared_pool and CredentialPool.may_have_credentials(("public",), required_tier):
+            # 公共凭证单独查询，和自己的凭证按同样的顺序合并（去掉自己的公开凭证的重复项）
+            public_rows = await CredentialPool._fetch_dispatch_rows(
+                db, query.where(Credential.is_public == true()), cd_filter, limit
+            )
+            own_ids = {c.id for c, _ in rows}
+            rows = sorted(
+                rows + [row for row in public_rows if row[0].id not in own_ids],
+                key=lambda row: (
+                    row[1],
+                    row[0].last_used_at is not None,
+                    row[0].last_used_at or datetime.min
+                )
+            )[:limit]
         
-        total_count = len(credentials)
-        available_count = len(available_credentials)
-        in_cd_count = total_count - available_count
+        if not rows:
+            return []
         
-        if not available_credentials:
-            # 所有凭证都在 CD 中，选择第一个（按 last_used_at 排序的）
-            credential = credentials[0]
-            print(f"[CD] 模型组={model_group}, CD={cd_seconds}秒 | 全部{total_count}个凭证都在CD中，选择: {credential.email}", flush=True)
+        credential, first_in_cd = rows[0]
+        if first_in_cd:
+            # 所有凭证都在 CD 中，按 last_used_at 排序选择
+            logger.debug("[CD] 模型组=%s, CD=%s秒 | 全部凭证都在CD中，选择: %s", model_group, cd_seconds, credential.email)
         else:
             # 选择最久未使用的凭证
-            credential = available_credentials[0]
-            print(f"[CD] 模型组={model_group}, CD={cd_seconds}秒 | 可用{available_count}/{total_count}个, 选择: {credential.email}", flush=True)
+            logger.debug("[CD] 模型组=%s, CD=%s秒 | 选择: %s", model_group, cd_seconds, credential.email)
         
-        # 更新使用时间和计数
-        now = datetime.utcnow()
-        credential.last_used_at = now
-        credential.total_requests += 1
+        return [c for c, _ in rows]
+    
+    @staticmethod
+    async def _fetch_dispatch_rows(db: AsyncSession, query, cd_filter, limit: int) -> list:
+        """
+        执行一个范围的调度查询，返回 [(凭证, 是否在 CD 中)]
+        cd_filter: (不在 CD 中的条件, 在 CD 中的条件)，为 None 表示没有 CD
+        先只查不在 CD 中的凭证，不足 limit 条时再用 CD 中的凭证补足
+        """
+        if cd_filter is None:
+            result = await db.execute(query.limit(limit))
+            return [(c, False) for c in result.scalars()]
         
-        # 更新对应模型组的 CD 时间
-        if model_group == "30":
-            credential.last_used_30 = now
-        elif model_group == "pro":
-            credential.last_used_pro = now
-        else:
-            credential.last_used_flash = now
+        ready_filter, cd_only_filter = cd_filter
+        result = await db.execute(query.where(ready_filter).limit(limit))
+        rows = [(c, False) for c in result.scalars()]
+        if len(rows) < limit:
+            result = await db.execute(query.where(cd_only_filter).limit(limit - len(rows)))
+            rows += [(c, True) for c in result.scalars()]
+        return rows
+    
+    # get_available_credential 一次取出的候选数量（并发请求抢占失败时依次尝试下一个）
+    CLAIM_CANDIDATES = 3
+    
+    @staticmethod
+    async def claim_credential(db: AsyncSession, credential: Credential, model: str = None) -> bool:
+        """
+        原子地占用一个候选凭证并记录本次使用
+        只有 last_used_at 仍是查询时读到的值才更新（比较并交换），
+        并发请求选中了同一个凭证时只有一个能占用成功，其余返回 False 换下一个候选
+        """
+        model_group = CredentialPool.get_model_group(model)
+        last_used_column = CredentialPool.get_last_used_column(model_group)
         
+        seen = credential.last_used_at
+        now = datetime.utcnow()
+        result = await db.execute(
+            update(Credential)
+            .where(
+                Credential.id == credential.id,
+                Credential.last_used_at.is_(None) if seen is None else Credential.last_used_at == seen
+            )
+            .values({
+                Credential.last_used_at: now,
+                last_used_column: now,
+            })
+            .execution_options(synchronize_session=False)
+        )
         await db.commit()
-        
+        if result.rowcount == 0:
+            return False
+        set_committed_value(credential, "last_used_at", now)
+        set_committed_value(credential, last_used_column.key, now)
+        return True
+    
+    @staticmethod
+    async def claim_next_credential(db: AsyncSession, candidates, model: str = None) -> Optional[Credential]:
+        """
+        从候选凭证迭代器中依次尝试占用，返回第一个占用成功的凭证
+        全部被并发请求抢先时退回使用最后一个候选（仍可用，只是与其他请求共用），没有候选时返回 None
+        """
+        credential = None
+        for credential in candidates:
+            if await CredentialPool.claim_credential(db, credential, model):
+                return credential
+        if credential is not None:
+            await CredentialPool.mark_credential_used(db, credential, model)
         return credential
     
+    @staticmethod
+    async def mark_credential_used(db: AsyncSession, credential: Credential, model: str = None):
+        """
+        记录凭证被使用：一条 UPDATE 更新使用时间和对应模型组的 CD 时间（调度依据，需立即生效）
+        请求计数 total_requests 随使用日志由日志队列批量写入
+        """
+        model_group = CredentialPool.get_model_group(model)
+        last_used_column = CredentialPool.get_last_used_column(model_group)
+        
+        now = datetime.utcnow()
+        await db.execute(
+            update(Credential)
+            .where(Credential.id == credential.id)
+            .values({
+                Credential.last_used_at: now,
+                last_used_column: now,
+            })
+        )
+        await db.commit()
+    
     @staticmethod
     async def check_user_has_public_creds(db: AsyncSession, user_id: int) -> bool:
         """检查用户是否有公开的凭证（是否参与大锅饭）"""
-        result = await db.execute(
-            select(Credential)
-            .where(Credential.user_id == user_id)
-            .where(Credential.is_public == True)
-            .where(Credential.is_active == True)
-            .limit(1)
-        )
-        return result.scalar_one_or_none() is not None
+        _, has_public = await CredentialPool.get_user_credential_flags(db, user_id)
+        return has_public
+    
+    # access_token 缓存 {credential_id: (access_token, 过期时间戳)}
+    _token_cache: Dict[int, Tuple[str, float]] = {}
+    TOKEN_EXPIRY_BUFFER = 60  # 提前 60 秒视为过期
+    
+    @staticmethod
+    def get_cached_access_token(credential_id: int) -> Optional[str]:
+        """获取缓存中仍有效的 access_token"""
+        cached = CredentialPool._token_cache.get(credential_id)
+        if not cached:
+            return None
+        token, expires_at = cached
+        if time.time() >= expires_at - CredentialPool.TOKEN_EXPIRY_BUFFER:
+            CredentialPool._token_cache.pop(credential_id, None)
+            return None
+        return token
+    
+    # 本进程内已作废 token 的凭证（数据库中的过期时间不再可信，需刷新后才能使用）
+    # 刷新得到新 token 或凭证删除时移除
+    _token_revoked: set = set()
+    
+    @staticmethod
+    def invalidate_access_token(credential_id: int):
+        """清除凭证的 access_token 缓存"""
+        CredentialPool._token_cache.pop(credential_id, None)
+        CredentialPool._token_revoked.add(credential_id)
+    
+    @staticmethod
+    def is_auth_error(error: str) -> bool:
+        """错误信息是否表示认证失败 (401/403)"""
+        return bool(error) and ("401" in error or "403" in error or "PERMISSION_DENIED" in error)
     
     @staticmethod
     async def refresh_access_token(credential: Credential) -> Optional[str]:
@@ -268,90 +574,291 @@ class CredentialPool:
         使用 refresh_token 刷新 access_token
         返回新的 access_token，失败返回 None
         """
-        refresh_token = decrypt_credential(credential.refresh_token)
+        # 三个字段在一次线程调用中解密（未命中解密缓存时不阻塞事件循环）
+        refresh_token, own_client_id, own_client_secret = await asyncio.to_thread(
+            decrypt_credentials, credential.refresh_token, credential.client_id, credential.client_secret
+        )
         if not refresh_token:
-            print(f"[Token刷新] refresh_token 解密失败", flush=True)
+            logger.error("[Token刷新] refresh_token 解密失败")
             return None
         
         # 优先使用凭证自己的 client_id/secret，否则使用系统配置
-        if credential.client_id and credential.client_secret:
-            client_id = decrypt_credential(credential.client_id)
-            client_secret = decrypt_credential(credential.client_secret)
-            print(f"[Token刷新] 使用凭证自己的 client_id: {client_id[:20]}...", flush=True)
+        if own_client_id and own_client_secret:
+            client_id = own_client_id
+            client_secret = own_client_secret
+            logger.debug("[Token刷新] 使用凭证自己的 client_id: %s...", client_id[:20])
         else:
             client_id = settings.google_client_id
             client_secret = settings.google_client_secret
-            print(f"[Token刷新] 使用系统配置的 client_id", flush=True)
+            logger.debug("[Token刷新] 使用系统配置的 client_id")
         
-        print(f"[Token刷新] 开始刷新 token, refresh_token 前20字符: {refresh_token[:20]}...", flush=True)
+        logger.debug("[Token刷新] 开始刷新 token, refresh_token 前20字符: %s...", refresh_token[:20])
         
         try:
-            async with httpx.AsyncClient(timeout=15) as client:
-                response = await client.post(
-                    "https://oauth2.googleapis.com/token",
-                    data={
-                        "client_id": client_id,
-                        "client_secret": client_secret,
-                        "refresh_token": refresh_token,
-                        "grant_type": "refresh_token"
-                    }
-                )
-                data = response.json()
-                print(f"[Token刷新] 响应状态: {response.status_code}", flush=True)
-                
-                if "access_token" in data:
-                    print(f"[Token刷新] 刷新成功!", flush=True)
-                    return data["access_token"]
-                print(f"[Token刷新] 刷新失败: {data.get('error', 'unknown')} - {data.get('error_description', '')}", flush=True)
-                return None
+            client = get_http_client()
+            response = await client.post(
+                OAUTH_TOKEN_URL,
+                content=_refresh_form_body(client_id, client_secret, refresh_token),
+                headers=FORM_HEADERS,
+                timeout=15
+            )
+            data = response.json()
+            logger.debug("[Token刷新] 响应状态: %s", response.status_code)
+            
+            if "access_token" in data:
+                logger.debug("[Token刷新] 刷新成功!")
+                if credential.id:
+                    expires_in = data.get("expires_in") or 3600
+                    CredentialPool._token_cache[credential.id] = (data["access_token"], time.time() + expires_in)
+                    CredentialPool._token_revoked.discard(credential.id)
+                return data["access_token"]
+            logger.error("[Token刷新] 刷新失败: %s - %s", data.get('error', 'unknown'), data.get('error_description', ''))
+            return None
         except Exception as e:
-            print(f"[Token刷新] 异常: {e}", flush=True)
+            logger.error("[Token刷新] 异常: %s", e)
             return None
     
+    # 进行中的 token 刷新 {credential_id: Task}，同一凭证的并发刷新合并为一次
+    _refresh_inflight: Dict[int, "asyncio.Task"] = {}
+    
+    @staticmethod
+    async def start_refresh(credential: Credential) -> Optional[str]:
+        """
+        发起刷新，并登记为进行中，供同一凭证的其他请求等待
+        调用方在检查进行中的刷新之后还有 await（读取密钥），这里在登记前再检查一次，
+        检查和登记之间没有 await，保证同一凭证同时只有一个刷新请求
+        """
+        if not credential.id:
+            return await CredentialPool.refresh_access_token(credential)
+        
+        credential_id = credential.id
+        cached_token = CredentialPool.get_cached_access_token(credential_id)
+        if cached_token:
+            return cached_token
+        task = CredentialPool._refresh_inflight.get(credential_id)
+        if task is not None:
+            return await asyncio.shield(task)
+        
+        task = asyncio.create_task(CredentialPool._refresh_and_store(credential))
+        CredentialPool._refresh_inflight[credential_id] = task
+        
+        def _done(t):
+            if CredentialPool._refresh_inflight.get(credential_id) is t:
+                del CredentialPool._refresh_inflight[credential_id]
+        task.add_done_callback(_done)
+        
+        # shield：发起请求被取消时，刷新仍继续，等待中的其他请求照常拿到结果
+        return await asyncio.shield(task)
+    
+    @staticmethod
+    async def _refresh_and_store(credential: Credential) -> Optional[str]:
+        """刷新 token 并写回数据库（每次刷新只由刷新任务写一次，等待同一刷新的请求不再重复写库）"""
+        new_token = await CredentialPool.refresh_access_token(credential)
+        if not new_token:
+            return None
+        
+        # 更新数据库中的 access_token（直接 UPDATE，不经过 ORM 脏检查和 flush），过期时间与内存缓存一致
+        encrypted_token = await asyncio.to_thread(encrypt_credential, new_token)
+        cached = CredentialPool._token_cache.get(credential.id)
+        expires_at = datetime.utcfromtimestamp(cached[1]) if cached else None
+        try:
+            async with async_session() as write_db:
+                await write_db.execute(
+                    update(Credential)
+                    .where(Credential.id == credential.id)
+                    .values(api_key=encrypted_token, access_token_expires_at=expires_at)
+                )
+                await write_db.commit()
+        except Exception as e:
+            # 写库失败不影响本次使用，token 仍在内存缓存中
+            logger.error("[Token刷新] 凭证 %s 写回 token 失败: %s", credential.id, e)
+            return new_token
+        set_committed_value(credential, "api_key", encrypted_token)
+        set_committed_value(credential, "access_token_expires_at", expires_at)
+        return new_token
+    
+    @staticmethod
+    async def load_secrets(credential: Credential):
+        """
+        读取调度查询时未加载的加密字段（api_key / refresh_token / client_id / client_secret）
+        使用独立的短会话，读完即归还连接，不让请求的会话在随后的 token 刷新期间占用连接
+        """
+        if not credential.id or "api_key" not in inspect(credential).unloaded:
+            return
+        async with async_session() as db:
+            result = await db.execute(
+                select(
+                    Credential.api_key,
+                    Credential.refresh_token,
+                    Credential.client_id,
+                    Credential.client_secret
+                ).where(Credential.id == credential.id)
+            )
+            row = result.one_or_none()
+        if row is None:
+            return
+        for key, value in row._mapping.items():
+            set_committed_value(credential, key, value)
+    
     @staticmethod
     async def get_access_token(credential: Credential, db: AsyncSession) -> Optional[str]:
         """
         获取可用的 access_token
         优先使用缓存的，过期则刷新
+        读取密钥和写回新 token 都使用独立的短会话，db 参数仅为兼容保留
         """
+        # OAuth 凭证：缓存的 token 未过期则直接使用
+        if credential.credential_type == "oauth" and credential.id:
+            cached_token = CredentialPool.get_cached_access_token(credential.id)
+            if cached_token:
+                return cached_token
+            
+            # 其他请求正在刷新同一凭证：等待其结果（由刷新任务写库）
+            inflight = CredentialPool._refresh_inflight.get(credential.id)
+            if inflight is not None:
+                return await asyncio.shield(inflight)
+        
+        await CredentialPool.load_secrets(credential)
+        
+        # 内存缓存中没有（如服务重启后），但数据库中保存的 token 仍未过期：直接使用，不发起刷新
+        expires_at = credential.access_token_expires_at
+        if (
+            credential.credential_type == "oauth" and credential.id and expires_at
+            and credential.id not in CredentialPool._token_revoked
+        ):
+            expires_ts = expires_at.replace(tzinfo=timezone.utc).timestamp()
+            if expires_ts - CredentialPool.TOKEN_EXPIRY_BUFFER > time.time():
+                access_token = decrypt_credential(credential.api_key)
+                if access_token:
+                    CredentialPool._token_cache[credential.id] = (access_token, expires_ts)
+                    return access_token
+        
         # OAuth 凭证需要刷新
         if credential.credential_type == "oauth" and credential.refresh_token:
             # 尝试刷新 token
-            new_token = await CredentialPool.refresh_access_token(credential)
-            if new_token:
-                # 更新数据库中的 access_token
-                credential.api_key = encrypt_credential(new_token)
-                await db.commit()
-                return new_token
-            return None
+            new_token = await CredentialPool.start_refresh(credential)
+            if new_token and not credential.id:
+                # 未入库的临时凭证（上传检测时）只更新对象本身
+                credential.api_key = await asyncio.to_thread(encrypt_credential, new_token)
+            return new_token
         
         # 普通 API Key 直接返回
         return decrypt_credential(credential.api_key)
     
+    # 凭证错误累计 {credential_id: (错误次数, 最后一次错误, 是否有认证失败)}，由后台任务定期批量写库
+    _error_accum: Dict[int, Tuple[int, str, bool]] = {}
+    _error_flush_event: Optional[asyncio.Event] = None
+    ERROR_FLUSH_INTERVAL = 0.5  # 秒
+    ERROR_FLUSH_BATCH = 100     # 累计错误达到该数量时立即写库
+    
     @staticmethod
     async def mark_credential_error(db: AsyncSession, credential_id: int, error: str):
-        """标记凭证错误"""
+        """
+        标记凭证错误
+        只在内存中累计，failed_requests / last_error 由 run_error_flusher 批量写入
+        只有认证失败 (401/403) 才作废 token，5xx、超时等错误不影响 token，避免多余的 OAuth 刷新
+        """
+        auth_failed = CredentialPool.is_auth_error(error)
+        if auth_failed:
+            CredentialPool.invalidate_access_token(credential_id)
         # 过滤掉无法编码的 UTF-16 代理字符（如不完整的 emoji）
         safe_error = error.encode('utf-8', errors='surrogatepass').decode('utf-8', errors='replace') if error else ""
-        await db.execute(
-            update(Credential)
-            .where(Credential.id == credential_id)
-            .values(
-                failed_requests=Credential.failed_requests + 1,
-                last_error=safe_error[:1000]  # 限制长度防止过长
+        count, _, revoke = CredentialPool._error_accum.get(credential_id, (0, "", False))
+        # 限制长度防止过长
+        CredentialPool._error_accum[credential_id] = (count + 1, safe_error[:1000], revoke or auth_failed)
+        
+        event = CredentialPool._error_flush_event
+        if event is not None and len(CredentialPool._error_accum) >= CredentialPool.ERROR_FLUSH_BATCH:
+            event.set()
+    
+    @staticmethod
+    async def flush_credential_errors():
+        """把累计的凭证错误一次写入数据库"""
+        if not CredentialPool._error_accum:
+            return
+        # 整体替换字典（中间没有 await，不需要加锁）
+        errors, CredentialPool._error_accum = CredentialPool._error_accum, {}
+        
+        params = [
+            {"b_id": credential_id, "b_count": count, "b_error": error}
+            for credential_id, (count, error, _) in errors.items()
+        ]
+        revoked_ids = [credential_id for credential_id, (_, _, revoke) in errors.items() if revoke]
+        table = Credential.__table__
+        async with async_session() as db:
+            await db.execute(
+                update(table)
+                .where(table.c.id == bindparam("b_id"))
+                .values(
+                    failed_requests=table.c.failed_requests + bindparam("b_count"),
+                    last_error=bindparam("b_error")
+                ),
+                params
             )
-        )
-        await db.commit()
+            if revoked_ids:
+                # 认证失败的凭证下次使用时重新刷新 token
+                await db.execute(
+                    update(table)
+                    .where(table.c.id.in_(revoked_ids))
+                    .values(access_token_expires_at=None)
+                )
+            await db.commit()
+    
+    @staticmethod
+    async def run_error_flusher():
+        """后台任务：每 ERROR_FLUSH_INTERVAL 秒（或累计够 ERROR_FLUSH_BATCH 个凭证）写入一次凭证错误"""
+        CredentialPool._error_flush_event = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(
+                    CredentialPool._error_flush_event.wait(),
+                    timeout=CredentialPool.ERROR_FLUSH_INTERVAL
+                )
+            except asyncio.TimeoutError:
+                pass
+            CredentialPool._error_flush_event.clear()
+            try:
+                await CredentialPool.flush_credential_errors()
+            except Exception as e:
+                logger.error("[凭证错误] 批量写入失败: %s", e)
+    
+    # 后台写入任务（保留引用防止任务在完成前被回收）
+    _background_writes: set = set()
+    
+    @staticmethod
+    def _spawn_write(coro):
+        """在后台执行数据库写入，调用方不等待提交，也不占用请求的数据库连接"""
+        task = asyncio.create_task(coro)
+        CredentialPool._background_writes.add(task)
+        task.add_done_callback(CredentialPool._background_writes.discard)
+    
+    @staticmethod
+    async def wait_background_writes():
+        """等待所有后台写入完成（应用关闭时调用）"""
+        if CredentialPool._background_writes:
+            await asyncio.gather(*CredentialPool._background_writes, return_exceptions=True)
     
     @staticmethod
     async def disable_credential(db: AsyncSession, credential_id: int):
-        """禁用凭证"""
-        await db.execute(
-            update(Credential)
-            .where(Credential.id == credential_id)
-            .values(is_active=False)
-        )
-        await db.commit()
+        """
+        禁用凭证
+        在后台用独立会话写入，db 参数仅为兼容保留
+        """
+        CredentialPool.invalidate_access_token(credential_id)
+        CredentialPool._spawn_write(CredentialPool._disable_credential(credential_id))
+    
+    @staticmethod
+    async def _disable_credential(credential_id: int):
+        try:
+            async with async_session() as db:
+                await db.execute(
+                    update(Credential)
+                    .where(Credential.id == credential_id)
+                    .values(is_active=False)
+                )
+                await db.commit()
+        except Exception as e:
+            logger.error("[凭证禁用] 凭证 %s 禁用失败: %s", credential_id, e)
     
     @staticmethod
     async def handle_credential_failure(db: AsyncSession, credential_id: int, error: str):
@@ -360,38 +867,57 @@ class CredentialPool:
         1. 标记错误
         2. 如果是认证错误 (401/403)，禁用凭证
         3. 降级用户额度（如果之前有奖励）
+        禁用和降级在后台用独立会话写入，db 参数仅为兼容保留
         """
-        from app.models.user import User
-        
         # 标记错误
         await CredentialPool.mark_credential_error(db, credential_id, error)
         
         # 检查是否是认证失败
-        if "401" in error or "403" in error or "PERMISSION_DENIED" in error:
-            # 获取凭证信息
-            result = await db.execute(select(Credential).where(Credential.id == credential_id))
-            cred = result.scalar_one_or_none()
-            
-            if cred and cred.is_active:
+        if CredentialPool.is_auth_error(error):
+            CredentialPool._spawn_write(CredentialPool._disable_failed_credential(credential_id, error))
+    
+    @staticmethod
+    async def _disable_failed_credential(credential_id: int, error: str):
+        """
+        禁用认证失败的凭证，公开凭证同时扣除贡献者的奖励额度
+        禁用用一条带 RETURNING 的条件 UPDATE 完成（只有仍启用的凭证会返回行），扣额度再一条 UPDATE
+        """
+        from app.models.user import User
+        
+        try:
+            async with async_session() as db:
                 # 禁用凭证
-                cred.is_active = False
+                result = await db.execute(
+                    update(Credential)
+                    .where(Credential.id == credential_id, Credential.is_active == true())
+                    .values(is_active=False)
+                    .returning(Credential.is_public, Credential.user_id, Credential.model_tier)
+                )
+                row = result.one_or_none()
+                if row is None:
+                    # 凭证不存在或已被禁用
+                    return
                 
                 # 如果是公开凭证，根据凭证等级降级用户奖励配额
-                if cred.is_public and cred.user_id:
-                    user_result = await db.execute(select(User).where(User.id == cred.user_id))
-                    user = user_result.scalar_one_or_none()
-                    if user:
-                        # 根据凭证等级扣除奖励额度：2.5=flash+25pro, 3.0=flash+25pro+30pro
-                        if cred.model_tier == "3":
-                            deduct = settings.quota_flash + settings.quota_25pro + settings.quota_30pro
-                        else:
-                            deduct = settings.quota_flash + settings.quota_25pro
-                        # 只扣除奖励配额，不影响基础配额
-                        user.bonus_quota = max(0, (user.bonus_quota or 0) - deduct)
-                        print(f"[凭证降级] 用户 {user.username} 凭证失效，扣除 {deduct} 奖励额度 (等级: {cred.model_tier})", flush=True)
+                if row.is_public and row.user_id:
+                    # 根据凭证等级扣除奖励额度：2.5=flash+25pro, 3.0=flash+25pro+30pro
+                    if row.model_tier == "3":
+                        deduct = settings.quota_flash + settings.quota_25pro + settings.quota_30pro
+                    else:
+                        deduct = settings.quota_flash + settings.quota_25pro
+                    # 只扣除奖励配额，不影响基础配额
+                    bonus_quota = func.coalesce(User.bonus_quota, 0)
+                    await db.execute(
+                        update(User)
+                        .where(User.id == row.user_id)
+                        .values(bonus_quota=case((bonus_quota > deduct, bonus_quota - deduct), else_=0))
+                    )
+                    logger.warning("[凭证降级] 用户 %s 凭证失效，扣除 %s 奖励额度 (等级: %s)", row.user_id, deduct, row.model_tier)
                 
                 await db.commit()
-                print(f"[凭证禁用] 凭证 {credential_id} 已禁用: {error}", flush=True)
+                logger.warning("[凭证禁用] 凭证 %s 已禁用: %s", credential_id, error)
+        except Exception as e:
+            logger.error("[凭证禁用] 凭证 %s 禁用失败: %s", credential_id, e)
     
     @staticmethod
     def parse_429_retry_after(error_text: str, headers: dict = None) -> int:
@@ -415,7 +941,7 @@ class CredentialPool:
             if retry_after:
                 try:
                     cd_seconds = int(retry_after)
-                    print(f"[429 CD] 从 Retry-After 头解析到 CD: {cd_seconds}s", flush=True)
+                    logger.info("[429 CD] 从 Retry-After 头解析到 CD: %ss", cd_seconds)
                     return cd_seconds
                 except:
                     pass
@@ -425,24 +951,24 @@ class CredentialPool:
         match = re.search(r'"retryDelay"\s*:\s*"(\d+)s?"', error_text)
         if match:
             cd_seconds = int(match.group(1))
-            print(f"[429 CD] 从 retryDelay 解析到 CD: {cd_seconds}s", flush=True)
+            logger.info("[429 CD] 从 retryDelay 解析到 CD: %ss", cd_seconds)
             return cd_seconds
         
         # 3. 尝试匹配 "retry after X seconds" 格式
         match = re.search(r'retry\s+after\s+(\d+)\s*s', error_text, re.IGNORECASE)
         if match:
             cd_seconds = int(match.group(1))
-            print(f"[429 CD] 从文本解析到 CD: {cd_seconds}s", flush=True)
+            logger.info("[429 CD] 从文本解析到 CD: %ss", cd_seconds)
             return cd_seconds
         
         # 4. 尝试匹配纯数字秒数
         match = re.search(r'(\d+)\s*seconds?', error_text, re.IGNORECASE)
         if match:
             cd_seconds = int(match.group(1))
-            print(f"[429 CD] 从 seconds 解析到 CD: {cd_seconds}s", flush=True)
+            logger.info("[429 CD] 从 seconds 解析到 CD: %ss", cd_seconds)
             return cd_seconds
         
-        print(f"[429 CD] 未能解析 CD 时间，使用默认值", flush=True)
+        logger.warning("[429 CD] 未能解析 CD 时间，使用默认值")
         return 0
     
     @staticmethod
@@ -467,7 +993,7 @@ class CredentialPool:
         if cd_seconds <= 0:
             # 如果没有解析到 CD 时间，使用默认值 60 秒
             cd_seconds = 60
-            print(f"[429 CD] 使用默认 CD: {cd_seconds}s", flush=True)
+            logger.info("[429 CD] 使用默认 CD: %ss", cd_seconds)
         
         # 确定模型组
         model_group = CredentialPool.get_model_group(model)
@@ -504,14 +1030,18 @@ class CredentialPool:
                 cred.last_used_flash = last_used
             
             await db.commit()
-            print(f"[429 CD] 凭证 {credential_id} 模型组 {model_group} 设置 CD {cd_seconds}s", flush=True)
+            logger.info("[429 CD] 凭证 %s 模型组 %s 设置 CD %ss", credential_id, model_group, cd_seconds)
         
         return cd_seconds
     
     @staticmethod
     async def get_all_credentials(db: AsyncSession):
-        """获取所有凭证"""
-        result = await db.execute(select(Credential).order_by(Credential.created_at.desc()))
+        """获取所有凭证（列表展示用，只加载 api_key 一个加密字段）"""
+        result = await db.execute(
+            select(Credential)
+            .options(*CredentialPool.defer_secrets("api_key"))
+            .order_by(Credential.created_at.desc())
+        )
         return result.scalars().all()
     
     @staticmethod
@@ -523,104 +1053,156 @@ class CredentialPool:
         await db.refresh(credential)
         return credential
     
+    # 账号类型检测结果按 project_id 缓存的时间（秒），Pro/Free 很少变化
+    ACCOUNT_TYPE_CACHE_TTL = 24 * 3600
+    
+    @staticmethod
+    def _account_type_key(project_id: str) -> str:
+        return f"{CACHE_KEYS['creds']}account_type:{project_id}"
+    
+    @staticmethod
+    def forget_account_type(project_id: str):
+        """移除 project_id 的账号类型检测缓存（凭证删除或 project_id 变化时调用）"""
+        if project_id:
+            cache.delete(CredentialPool._account_type_key(project_id))
+    
+    @staticmethod
+    def forget_credentials(credentials):
+        """
+        凭证删除后清理内存中与其相关的缓存
+        credentials: 凭证对象或带 id / project_id 的查询行
+        """
+        for credential in credentials:
+            CredentialPool.forget_account_type(credential.project_id)
+            CredentialPool._token_cache.pop(credential.id, None)
+            CredentialPool._token_revoked.discard(credential.id)
+    
     @staticmethod
     async def detect_account_type(access_token: str, project_id: str) -> dict:
+        """
+        检测账号类型（Pro/Free），确定的结果按 project_id 缓存 ACCOUNT_TYPE_CACHE_TTL 秒
+        重复检测同一凭证时不再发起 Drive API / 并发探测请求
+        """
+        key = CredentialPool._account_type_key(project_id)
+        if project_id:
+            cached_result = cache.get(key)
+            if cached_result is not None:
+                return cached_result
+        
+        result = await CredentialPool._detect_account_type(access_token, project_id)
+        if project_id and result.get("account_type") in ("pro", "free"):
+            cache.set(key, result, ttl=CredentialPool.ACCOUNT_TYPE_CACHE_TTL)
+        return result
+    
+    @staticmethod
+    async def _detect_account_type(access_token: str, project_id: str) -> dict:
         """
         检测账号类型（Pro/Free）
         
         方式1: 使用 Google Drive API 检测存储空间（需要 drive scope）
-        方式2: 如果 Drive API 失败，回退到连续请求检测
+        方式2: 如果 Drive API 失败，回退到并发请求检测
         
         Returns:
             {"account_type": "pro"/"free"/"unknown", "storage_gb": float}
         """
-        import asyncio
-        
         headers = {"Authorization": f"Bearer {access_token}"}
         
-        print(f"[检测账号] 尝试使用 Drive API 检测存储空间...", flush=True)
+        logger.info("[检测账号] 尝试使用 Drive API 检测存储空间...")
         
-        async with httpx.AsyncClient(timeout=15.0) as client:
-            # 方式1: 尝试 Drive API
-            try:
-                resp = await client.get(
-                    "https://www.googleapis.com/drive/v3/about?fields=storageQuota",
-                    headers=headers
-                )
-                print(f"[检测账号] Drive API 响应: {resp.status_code}", flush=True)
+        client = get_http_client()
+        # 方式1: 尝试 Drive API
+        try:
+            resp = await client.get(
+                "https://www.googleapis.com/drive/v3/about?fields=storageQuota",
+                headers=headers,
+                timeout=15.0
+            )
+            logger.info("[检测账号] Drive API 响应: %s", resp.status_code)
+            
+            if resp.status_code == 200:
+                data = resp.json()
+                quota = data.get("storageQuota", {})
+                limit = int(quota.get("limit", 0))
                 
-                if resp.status_code == 200:
-                    data = resp.json()
-                    quota = data.get("storageQuota", {})
-                    limit = int(quota.get("limit", 0))
+                if limit > 0:
+                    storage_gb = round(limit / (1024**3), 1)
+                    logger.info("[检测账号] 存储空间: %s GB", storage_gb)
                     
-                    if limit > 0:
-                        storage_gb = round(limit / (1024**3), 1)
-                        print(f"[检测账号] 存储空间: {storage_gb} GB", flush=True)
+                    # Pro 账号是 2TB (2000GB) 存储空间
+                    if storage_gb >= 2000:
+                        return {"account_type": "pro", "storage_gb": storage_gb}
+                    else:
+                        return {"account_type": "free", "storage_gb": storage_gb}
+            elif resp.status_code == 403:
+                logger.info("[检测账号] Drive API 无权限，回退到并发请求检测")
+            else:
+                logger.info("[检测账号] Drive API 意外响应: %s", resp.status_code)
                         
-                        # Pro 账号是 2TB (2000GB) 存储空间
-                        if storage_gb >= 2000:
-                            return {"account_type": "pro", "storage_gb": storage_gb}
-                        else:
-                            return {"account_type": "free", "storage_gb": storage_gb}
-                elif resp.status_code == 403:
-                    print(f"[检测账号] Drive API 无权限，回退到连续请求检测", flush=True)
-                else:
-                    print(f"[检测账号] Drive API 意外响应: {resp.status_code}", flush=True)
-                            
-            except Exception as e:
-                print(f"[检测账号] Drive API 异常: {e}", flush=True)
-            
-            # 方式2: 回退到连续请求检测
-            print(f"[检测账号] Drive API 无权限，使用连续请求检测...", flush=True)
-            
-            headers["Content-Type"] = "application/json"
-            url = "https://cloudcode-pa.googleapis.com/v1internal:generateContent"
-            payload = {
-                "model": "gemini-2.0-flash",
-                "project": project_id,
-                "request": {
-                    "contents": [{"role": "user", "parts": [{"text": "1"}]}],
-                    "generationConfig": {"maxOutputTokens": 1}
-                }
+        except Exception as e:
+            logger.error("[检测账号] Drive API 异常: %s", e)
+        
+        # 方式2: 回退到并发请求检测
+        logger.info("[检测账号] Drive API 无权限，使用并发请求检测...")
+        
+        headers["Content-Type"] = "application/json"
+        url = "https://cloudcode-pa.googleapis.com/v1internal:generateContent"
+        payload = {
+            "model": "gemini-2.0-flash",
+            "project": project_id,
+            "request": {
+                "contents": [{"role": "user", "parts": [{"text": "1"}]}],
+                "generationConfig": {"maxOutputTokens": 1}
             }
-            
-            # 先等待 2 秒让之前的请求 RPM 窗口过去
-            print(f"[检测账号] 等待 2 秒后开始连续请求检测...", flush=True)
-            await asyncio.sleep(2)
-            
-            success_count = 0
-            for i in range(5):  # 5 次检测
-                try:
-                    resp = await client.post(url, headers=headers, json=payload)
-                    print(f"[检测账号] 第 {i+1} 次请求: {resp.status_code}", flush=True)
+        }
+        
+        # 5 次中至少 3 次成功才判定为 Pro：先同时发出 3 次探测，每遇到一次 RPM 限速再补发一次
+        # 成功次数已够或已不可能够时结果即确定，不再发出新的探测并取消进行中的请求
+        probe_count = 5
+        required_success = 3
+        tasks = []
+        
+        def send_probe():
+            task = asyncio.create_task(client.post(url, headers=headers, json=payload, timeout=15.0))
+            tasks.append(task)
+            return task
+        
+        pending = {send_probe() for _ in range(required_success)}
+        success_count = 0
+        rate_limited = 0
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    try:
+                        resp = task.result()
+                    except Exception as e:
+                        logger.error("[检测账号] 请求异常: %s", e)
+                        return {"account_type": "unknown", "error": str(e)}
+                    logger.info("[检测账号] 第 %s 个响应: %s", success_count + rate_limited + 1, resp.status_code)
                     
                     if resp.status_code == 429:
                         error_text = resp.text.lower()
-                        print(f"[检测账号] 429 详情: {resp.text[:200]}", flush=True)
+                        logger.info("[检测账号] 429 详情: %s", resp.text[:200])
                         # 只有日配额用尽才能确定，RPM 限速不做判断
                         if "per day" in error_text or "daily" in error_text:
                             return {"account_type": "unknown", "error": "配额已用尽，无法判断"}
-                        # RPM 限速，等待后继续
-                        print(f"[检测账号] RPM 限速，等待后继续...", flush=True)
-                        await asyncio.sleep(3)
-                        continue
+                        logger.info("[检测账号] RPM 限速")
+                        rate_limited += 1
+                        if rate_limited > probe_count - required_success:
+                            logger.info("[检测账号] 只有 %s/%s 次成功，无法确定", success_count, len(tasks))
+                            return {"account_type": "unknown"}
+                        pending.add(send_probe())
                     elif resp.status_code == 200:
                         success_count += 1
+                        if success_count >= required_success:
+                            logger.info("[检测账号] %s/%s 次请求成功，判定为 Pro", success_count, len(tasks))
+                            return {"account_type": "pro"}
                     else:
-                        print(f"[检测账号] 非200响应: {resp.status_code}", flush=True)
+                        logger.info("[检测账号] 非200响应: %s", resp.status_code)
                         return {"account_type": "unknown"}
-                        
-                except Exception as e:
-                    print(f"[检测账号] 请求异常: {e}", flush=True)
-                    return {"account_type": "unknown", "error": str(e)}
-                
-                await asyncio.sleep(1.5)
-            
-            # 5 次中至少 3 次成功才判定为 Pro
-            if success_count >= 3:
-                print(f"[检测账号] {success_count}/5 次请求成功，判定为 Pro", flush=True)
-                return {"account_type": "pro"}
-            else:
-                print(f"[检测账号] 只有 {success_count}/5 次成功，无法确定", flush=True)
-                return {"account_type": "unknown"}
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        
+        return {"account_type": "unknown"}
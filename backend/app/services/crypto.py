@@ -1,18 +1,25 @@
 """凭证加密服务"""
 from cryptography.fernet import Fernet
 from base64 import urlsafe_b64encode
+from functools import lru_cache
 from hashlib import sha256
 from app.config import settings
 
 
-def get_fernet() -> Fernet:
-    """获取 Fernet 加密器（基于 SECRET_KEY 派生）"""
+@lru_cache(maxsize=4)
+def _fernet_for_key(secret_key: str) -> Fernet:
+    """按 SECRET_KEY 缓存 Fernet 加密器，避免每次加解密都重新派生密钥"""
     # 从 SECRET_KEY 派生一个 32 字节的密钥
-    key = sha256(settings.secret_key.encode()).digest()
+    key = sha256(secret_key.encode()).digest()
     fernet_key = urlsafe_b64encode(key)
     return Fernet(fernet_key)
 
 
+def get_fernet() -> Fernet:
+    """获取 Fernet 加密器（基于 SECRET_KEY 派生）"""
+    return _fernet_for_key(settings.secret_key)
+
+
 def encrypt_credential(plaintext: str) -> str:
     """加密凭证"""
     if not plaintext:
@@ -21,13 +28,34 @@ def encrypt_credential(plaintext: str) -> str:
     return fernet.encrypt(plaintext.encode()).decode()
 
 
-def decrypt_credential(ciphertext: str) -> str:
-    """解密凭证"""
-    if not ciphertext:
-        return ciphertext
+# 每个 OAuth 凭证有 refresh_token / client_id / client_secret 三个常用加密字段，
+# 容量按上千个凭证估算，避免凭证较多时缓存互相挤出
+DECRYPT_CACHE_SIZE = 4096
+
+
+@lru_cache(maxsize=DECRYPT_CACHE_SIZE)
+def _decrypt_cached(ciphertext: str, secret_key: str) -> str:
+    """
+    解密并缓存结果
+    密文变化（重新加密）时缓存键随之变化，不需要手动失效
+    """
     try:
-        fernet = get_fernet()
-        return fernet.decrypt(ciphertext.encode()).decode()
+        return _fernet_for_key(secret_key).decrypt(ciphertext.encode()).decode()
     except Exception:
         # 如果解密失败，可能是未加密的旧数据
         return ciphertext
+
+
+def decrypt_credential(ciphertext: str) -> str:
+    """解密凭证"""
+    if not ciphertext:
+        return ciphertext
+    return _decrypt_cached(ciphertext, settings.secret_key)
+
+
+def decrypt_credentials(*ciphertexts: str) -> tuple:
+    """
+    依次解密多个字段，按原顺序返回
+    供 asyncio.to_thread 一次性在线程中解密，避免多次线程切换
+    """
+    return tuple(decrypt_credential(ciphertext) for ciphertext in ciphertexts)
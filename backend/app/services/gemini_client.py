@@ -1,7 +1,33 @@
 import httpx
-import json
+import orjson
 from typing import AsyncGenerator, Optional, Dict, Any
 from app.config import settings
+from app.services.http_client import get_http_client, read_error_body
+from app.logger import get_logger
+
+
+logger = get_logger("gemini_client")
+
+# 内部 API 请求统一关闭安全过滤（所有请求共用同一份）
+SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "OFF"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "OFF"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "OFF"},
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "OFF"},
+]
+
+
+async def aiter_sse_lines(response) -> AsyncGenerator[bytes, None]:
+    """按行切分上游 SSE 原始字节流（不解码为 str），输出不含换行符的行"""
+    buffer = bytearray()
+    async for chunk in response.aiter_raw():
+        buffer += chunk
+        while (i := buffer.find(b"\n")) != -1:
+            line = bytes(buffer[:i]).rstrip(b"\r")
+            del buffer[:i + 1]
+            yield line
+    if buffer:
+        yield bytes(buffer)
 
 
 class GeminiClient:
@@ -13,6 +39,14 @@ class GeminiClient:
     def __init__(self, access_token: str, project_id: str = None):
         self.access_token = access_token
         self.project_id = project_id or ""
+        # 请求头只构建一次，重试/多次调用复用
+        self.headers = {
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json",
+            "User-Agent": "catiecli/1.0",
+        }
+        # 流式请求按原始字节分帧，不需要解压
+        self.stream_headers = {**self.headers, "Accept-Encoding": "identity"}
     
     async def generate_content(
         self,
@@ -24,12 +58,6 @@ class GeminiClient:
         """生成内容 (非流式) - 使用内部 API"""
         url = f"{self.INTERNAL_API_BASE}/v1internal:generateContent"
         
-        headers = {
-            "Authorization": f"Bearer {self.access_token}",
-            "Content-Type": "application/json",
-            "User-Agent": "catiecli/1.0",
-        }
-        
         # 构建内部 API 格式的 payload
         request_body = {"contents": contents}
         if generation_config:
@@ -38,12 +66,7 @@ class GeminiClient:
             request_body["systemInstruction"] = system_instruction
         
         # 添加安全设置
-        request_body["safetySettings"] = [
-            {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "OFF"},
-            {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "OFF"},
-            {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "OFF"},
-            {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "OFF"},
-        ]
+        request_body["safetySettings"] = SAFETY_SETTINGS
         
         payload = {
             "model": model,
@@ -51,8 +74,8 @@ class GeminiClient:
             "request": request_body,
         }
         
-        print(f"[GeminiClient] 请求: model={model}, project={self.project_id}", flush=True)
-        print(f"[GeminiClient] generationConfig: {generation_config}", flush=True)
+        logger.debug("[GeminiClient] 请求: model=%s, project=%s", model, self.project_id)
+        logger.debug("[GeminiClient] generationConfig: %s", generation_config)
         
         # 使用更细粒度的超时配置，避免长时间生成时连接中断
         timeout = httpx.Timeout(
@@ -61,20 +84,20 @@ class GeminiClient:
             write=30.0,      # 写入超时
             pool=30.0        # 连接池超时
         )
-        async with httpx.AsyncClient(timeout=timeout) as client:
-            response = await client.post(url, headers=headers, json=payload)
-            
-            # 打印所有响应头（调试用）
-            print(f"[GeminiClient] 响应头: {dict(response.headers)}", flush=True)
-            
-            if response.status_code != 200:
-                error_text = response.text
-                print(f"[GeminiClient] ❌ 错误 {response.status_code}: {error_text[:500]}", flush=True)
-                raise Exception(f"API Error {response.status_code}: {error_text}")
-            result = response.json()
-            # 调试：打印原始响应
-            print(f"[GeminiClient] ✅ 原始响应: {json.dumps(result, ensure_ascii=False)[:1000]}", flush=True)
-            return result
+        client = get_http_client()
+        response = await client.post(url, headers=self.headers, content=orjson.dumps(payload), timeout=timeout)
+        
+        # 打印所有响应头（调试用）
+        logger.debug("[GeminiClient] 响应头: %s", response.headers)
+        
+        if response.status_code != 200:
+            error_text = response.text
+            logger.error("[GeminiClient] ❌ 错误 %s: %s", response.status_code, error_text[:500])
+            raise Exception(f"API Error {response.status_code}: {error_text}")
+        result = response.json()
+        # 调试：打印原始响应
+        logger.debug("[GeminiClient] ✅ 原始响应: %.1000s", result)
+        return result
     
     async def generate_content_stream(
         self,
@@ -82,16 +105,10 @@ class GeminiClient:
         contents: list,
         generation_config: Optional[Dict] = None,
         system_instruction: Optional[Dict] = None
-    ) -> AsyncGenerator[str, None]:
-        """生成内容 (流式) - 使用内部 API"""
+    ) -> AsyncGenerator[bytes, None]:
+        """生成内容 (流式) - 使用内部 API，逐个输出 SSE data 的原始字节"""
         url = f"{self.INTERNAL_API_BASE}/v1internal:streamGenerateContent?alt=sse"
         
-        headers = {
-            "Authorization": f"Bearer {self.access_token}",
-            "Content-Type": "application/json",
-            "User-Agent": "catiecli/1.0",
-        }
-        
         # 构建内部 API 格式的 payload
         request_body = {"contents": contents}
         if generation_config:
@@ -100,12 +117,7 @@ class GeminiClient:
             request_body["systemInstruction"] = system_instruction
         
         # 添加安全设置
-        request_body["safetySettings"] = [
-            {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "OFF"},
-            {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "OFF"},
-            {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "OFF"},
-            {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "OFF"},
-        ]
+        request_body["safetySettings"] = SAFETY_SETTINGS
         
         payload = {
             "model": model,
@@ -113,19 +125,19 @@ class GeminiClient:
             "request": request_body,
         }
         
-        print(f"[GeminiClient] 流式请求: model={model}, project={self.project_id}", flush=True)
-        
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            async with client.stream(
-                "POST", url, headers=headers, json=payload
-            ) as response:
-                if response.status_code != 200:
-                    error_text = await response.aread()
-                    print(f"[GeminiClient] ❌ 流式错误 {response.status_code}: {error_text.decode()[:500]}", flush=True)
-                    raise Exception(f"API Error {response.status_code}: {error_text.decode()}")
-                async for line in response.aiter_lines():
-                    if line.startswith("data: "):
-                        yield line[6:]
+        logger.debug("[GeminiClient] 流式请求: model=%s, project=%s", model, self.project_id)
+        
+        client = get_http_client()
+        async with client.stream(
+            "POST", url, headers=self.stream_headers, content=orjson.dumps(payload)
+        ) as response:
+            if response.status_code != 200:
+                error_text = await read_error_body(response)
+                logger.error("[GeminiClient] ❌ 流式错误 %s: %s", response.status_code, error_text[:500])
+                raise Exception(f"API Error {response.status_code}: {error_text}")
+            async for line in aiter_sse_lines(response):
+                if line.startswith(b"data: "):
+                    yield line[6:]
     
     def is_fake_streaming(self, model: str) -> bool:
         """检查是否使用假流式"""
@@ -150,8 +162,8 @@ class GeminiClient:
         model: str,
         messages: list,
         **kwargs
-    ) -> AsyncGenerator[str, None]:
-        """OpenAI兼容的chat completions (流式)"""
+    ) -> AsyncGenerator[bytes, None]:
+        """OpenAI兼容的chat completions (流式，输出已编码的 SSE 字节)"""
         contents, system_instruction = self._convert_messages_to_contents(messages)
         generation_config = self._build_generation_config(model, kwargs)
         gemini_model = self._map_model_name(model)
@@ -164,7 +176,7 @@ class GeminiClient:
         model: str,
         messages: list,
         **kwargs
-    ) -> AsyncGenerator[str, None]:
+    ) -> AsyncGenerator[bytes, None]:
         """假流式: 先发心跳，拿到完整响应后一次性输出"""
         import asyncio
         
@@ -180,7 +192,7 @@ class GeminiClient:
             "model": model,
             "choices": [{"index": 0, "delta": {"role": "assistant"}, "finish_reason": None}]
         }
-        yield f"data: {json.dumps(initial_chunk)}\n\n"
+        yield b"data: " + orjson.dumps(initial_chunk) + b"\n\n"
         
         # 创建请求任务
         request_task = asyncio.create_task(
@@ -199,7 +211,7 @@ class GeminiClient:
         while not request_task.done():
             await asyncio.sleep(2)
             if not request_task.done():
-                yield f"data: {json.dumps(heartbeat_chunk)}\n\n"
+                yield b"data: " + orjson.dumps(heartbeat_chunk) + b"\n\n"
         
         # 获取完整响应
         try:
@@ -225,7 +237,7 @@ class GeminiClient:
                     "model": model,
                     "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}]
                 }
-                yield f"data: {json.dumps(content_chunk)}\n\n"
+                yield b"data: " + orjson.dumps(content_chunk) + b"\n\n"
             
             # 发送结束标记
             done_chunk = {
@@ -235,8 +247,8 @@ class GeminiClient:
                 "model": model,
                 "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]
             }
-            yield f"data: {json.dumps(done_chunk)}\n\n"
-            yield "data: [DONE]\n\n"
+            yield b"data: " + orjson.dumps(done_chunk) + b"\n\n"
+            yield b"data: [DONE]\n\n"
             
         except Exception as e:
             error_chunk = {
@@ -246,8 +258,8 @@ class GeminiClient:
                 "model": model,
                 "choices": [{"index": 0, "delta": {"content": f"\n\n[Error: {str(e)}]"}, "finish_reason": "stop"}]
             }
-            yield f"data: {json.dumps(error_chunk)}\n\n"
-            yield "data: [DONE]\n\n"
+            yield b"data: " + orjson.dumps(error_chunk) + b"\n\n"
+            yield b"data: [DONE]\n\n"
     
     def _build_generation_config(self, model: str, kwargs: dict) -> dict:
         """构建生成配置（包含 thinking 配置）"""
@@ -330,7 +342,7 @@ class GeminiClient:
                                         }
                                     })
                                 except Exception as e:
-                                    print(f"[GeminiClient] ⚠️ 解析图片数据失败: {e}", flush=True)
+                                    logger.warning("[GeminiClient] ⚠️ 解析图片数据失败: %s", e)
                             else:
                                 # URL 图片
                                 parts.append({
@@ -348,7 +360,7 @@ class GeminiClient:
                             parts.append({"fileData": item["fileData"]})
                         else:
                             # 未知格式，尝试作为文本处理
-                            print(f"[GeminiClient] ⚠️ 未知内容格式: {list(item.keys())}", flush=True)
+                            logger.warning("[GeminiClient] ⚠️ 未知内容格式: %s", list(item.keys()))
                     elif isinstance(item, str):
                         parts.append({"text": item})
             
@@ -471,10 +483,10 @@ class GeminiClient:
             }
         }
     
-    def _convert_to_openai_stream(self, chunk_data: str, model: str) -> str:
+    def _convert_to_openai_stream(self, chunk_data: bytes, model: str) -> bytes:
         """将Gemini流式响应转换为OpenAI SSE格式"""
         try:
-            data = json.loads(chunk_data)
+            data = orjson.loads(chunk_data)
             content = ""
             reasoning_content = ""
             
@@ -499,7 +511,7 @@ class GeminiClient:
                 delta["reasoning_content"] = reasoning_content
             
             if not delta:
-                return ""
+                return b""
             
             openai_chunk = {
                 "id": "chatcmpl-catiecli",
@@ -512,6 +524,6 @@ class GeminiClient:
                     "finish_reason": None
                 }]
             }
-            return f"data: {json.dumps(openai_chunk)}\n\n"
+            return b"data: " + orjson.dumps(openai_chunk) + b"\n\n"
         except:
-            return ""
+            return b""
@@ -0,0 +1,74 @@
+"""共享 HTTP 客户端（复用到 Google / OpenAI 的 keep-alive 连接）"""
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+import httpx
+
+
+_client: Optional[httpx.AsyncClient] = None
+
+# 流式请求出错时最多读取的错误内容字节数
+ERROR_BODY_LIMIT = 8192
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    获取全局共享的 httpx.AsyncClient
+    默认超时 120 秒，需要其他超时的请求在调用时传入 timeout=...
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=120.0,
+            limits=httpx.Limits(
+                max_keepalive_connections=100,
+                max_connections=200,
+                keepalive_expiry=30
+            )
+        )
+    return _client
+
+
+async def close_http_client():
+    """关闭共享客户端（应用关闭时调用）"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+class _TimeoutScopedClient:
+    """在共享客户端上使用固定默认超时的轻量包装（只提供 get / post）"""
+
+    def __init__(self, client: httpx.AsyncClient, timeout: float):
+        self._client = client
+        self._timeout = timeout
+
+    async def get(self, url, **kwargs) -> httpx.Response:
+        kwargs.setdefault("timeout", self._timeout)
+        return await self._client.get(url, **kwargs)
+
+    async def post(self, url, **kwargs) -> httpx.Response:
+        kwargs.setdefault("timeout", self._timeout)
+        return await self._client.post(url, **kwargs)
+
+
+@asynccontextmanager
+async def shared_http_client(timeout: float) -> AsyncIterator[_TimeoutScopedClient]:
+    """
+    替代 async with httpx.AsyncClient(timeout=...) as client 的写法，
+    请求走共享连接池，退出时不关闭连接
+    """
+    yield _TimeoutScopedClient(get_http_client(), timeout)
+
+
+async def read_error_body(response: httpx.Response, limit: int = ERROR_BODY_LIMIT) -> str:
+    """
+    读取流式响应的错误内容，最多 limit 字节
+    避免把上游返回的大错误页面整个读进内存
+    """
+    body = bytearray()
+    async for chunk in response.aiter_bytes():
+        body += chunk
+        if len(body) >= limit:
+            break
+    return bytes(body[:limit]).decode(errors="replace")
@@ -0,0 +1,231 @@
+"""
+使用日志写入队列
+请求路径只把日志放入内存队列，由后台任务批量写库并推送 WebSocket 通知，
+请求不再等待数据库提交和通知广播
+
+还没写入数据库的日志按用户计入待写入计数（pending_usage），
+速率限制和每日配额统计时加上这部分，避免排队期间的请求绕过限制
+"""
+import asyncio
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import insert, update, func
+
+from app.database import async_session
+from app.models.user import UsageLog, Credential
+from app.services.websocket import notify_log_update, notify_stats_update
+from app.logger import get_logger
+
+
+logger = get_logger("log_queue")
+
+# 队列积压超过该数量时输出警告（日志是配额统计依据，不丢弃）
+QUEUE_WARN_SIZE = 10000
+# 单批最多写入条数
+BATCH_SIZE = 200
+# 收到第一条日志后最多再等待的时间（秒）
+BATCH_WINDOW = 0.5
+# 整批写入失败后的重试等待时间（秒），重试用完后逐条写入
+RETRY_DELAYS = (0.5, 1, 2)
+
+_queue: "asyncio.Queue[tuple]" = asyncio.Queue()
+_flusher_task: Optional[asyncio.Task] = None
+# 停止信号
+_STOP = object()
+
+# 待写入的日志 {user_id: Counter({(created_at, model_tier): 条数})}
+_pending: Dict[int, Counter] = {}
+
+
+def _pending_key(record: dict) -> Tuple[datetime, Optional[int]]:
+    return record["created_at"], record.get("model_tier")
+
+
+def _track_pending(record: dict):
+    user_id = record.get("user_id")
+    if user_id is not None:
+        _pending.setdefault(user_id, Counter())[_pending_key(record)] += 1
+
+
+def _release_pending(records: Iterable[dict]):
+    """日志已写入数据库（或最终放弃）后从待写入计数中移除"""
+    for record in records:
+        user_id = record.get("user_id")
+        counter = _pending.get(user_id)
+        if counter is None:
+            continue
+        key = _pending_key(record)
+        counter[key] -= 1
+        if counter[key] <= 0:
+            del counter[key]
+        if not counter:
+            del _pending[user_id]
+
+
+def pending_usage(user_id: int, since: datetime, model_tiers: Optional[Iterable[int]] = None) -> int:
+    """
+    用户还没写入数据库的日志条数（created_at >= since，可按配额类别筛选）
+    速率限制 / 配额检查时与数据库中的计数相加
+    """
+    counter = _pending.get(user_id)
+    if not counter:
+        return 0
+    if model_tiers is not None:
+        model_tiers = set(model_tiers)
+    return sum(
+        count for (created_at, model_tier), count in counter.items()
+        if created_at >= since and (model_tiers is None or model_tier in model_tiers)
+    )
+
+
+def enqueue_log(record: dict, notify: Optional[dict] = None):
+    """
+    放入一条使用日志（不阻塞）
+    record: UsageLog 字段
+    notify: 写库后推送给管理员的日志摘要（可选）
+    """
+    record.setdefault("created_at", datetime.utcnow())
+    _track_pending(record)
+    _queue.put_nowait((record, notify))
+    if _queue.qsize() % QUEUE_WARN_SIZE == 0:
+        logger.warning("[日志队列] 积压 %d 条日志未写入", _queue.qsize())
+
+
+async def _collect_batch() -> Tuple[List[tuple], bool]:
+    """
+    等待第一条日志，然后在时间窗口内最多再取 BATCH_SIZE 条
+    返回 (日志列表, 是否收到停止信号)
+    """
+    first = await _queue.get()
+    if first is _STOP:
+        return [], True
+    batch = [first]
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + BATCH_WINDOW
+    while len(batch) < BATCH_SIZE:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        try:
+            item = await asyncio.wait_for(_queue.get(), timeout=remaining)
+        except asyncio.TimeoutError:
+            break
+        if item is _STOP:
+            return batch, True
+        batch.append(item)
+    return batch, False
+
+
+def _drain() -> List[tuple]:
+    """取出队列中剩余的全部日志"""
+    batch = []
+    while True:
+        try:
+            item = _queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return batch
+        if item is not _STOP:
+            batch.append(item)
+
+
+async def _write_records(records: List[dict]):
+    """
+    一次提交写入一批日志，并按凭证汇总更新请求计数
+    （凭证的最后使用时间在调度时已由 CredentialPool.mark_credential_used 更新）
+    """
+    # 每个凭证的请求数
+    credential_counts: Dict[int, int] = defaultdict(int)
+    for record in records:
+        credential_id = record.get("credential_id")
+        if credential_id:
+            credential_counts[credential_id] += 1
+
+    async with async_session() as session:
+        await session.execute(insert(UsageLog), records)
+        for credential_id, count in credential_counts.items():
+            await session.execute(
+                update(Credential)
+                .where(Credential.id == credential_id)
+                .values(total_requests=func.coalesce(Credential.total_requests, 0) + count)
+            )
+        await session.commit()
+
+
+async def _write_batch(batch: List[tuple]):
+    """
+    写入一批日志：整批写入失败时按 RETRY_DELAYS 重试，仍失败则逐条写入，
+    只有单条也写不进去的日志才放弃（记录错误日志）
+    写入后（或放弃后）从待写入计数中移除，再推送通知
+    """
+    records = [record for record, _ in batch]
+    written = False
+    for attempt, delay in enumerate((0,) + RETRY_DELAYS):
+        if delay:
+            await asyncio.sleep(delay)
+        try:
+            await _write_records(records)
+            written = True
+            break
+        except Exception as e:
+            logger.warning("[日志队列] 第 %d 次写入 %d 条日志失败: %s", attempt + 1, len(records), e)
+
+    if written:
+        _release_pending(records)
+    else:
+        # 逐条写入，避免个别异常数据拖累整批
+        lost = 0
+        for record in records:
+            try:
+                await _write_records([record])
+            except Exception as e:
+                lost += 1
+                logger.error("[日志队列] 丢弃一条写入失败的日志 (user_id=%s): %s", record.get("user_id"), e)
+            _release_pending([record])
+        if lost:
+            logger.error("[日志队列] 共 %d/%d 条日志写入失败", lost, len(records))
+
+    notifications = [notify for _, notify in batch if notify]
+    for notify in notifications:
+        await notify_log_update(notify)
+    if notifications:
+        await notify_stats_update()
+
+
+async def _flusher():
+    """后台任务：持续批量写入日志，收到停止信号后写完已取出的日志再退出"""
+    while True:
+        batch, stop = await _collect_batch()
+        if batch:
+            try:
+                await _write_batch(batch)
+            except Exception as e:
+                # 写库已在 _write_batch 内重试，这里只可能是通知推送失败
+                logger.error("[日志队列] 推送 %d 条日志通知失败: %s", len(batch), e)
+        if stop:
+            return
+
+
+def start_log_flusher():
+    """启动后台写入任务（应用启动时调用）"""
+    global _flusher_task
+    if _flusher_task is None or _flusher_task.done():
+        _flusher_task = asyncio.create_task(_flusher())
+
+
+async def stop_log_flusher():
+    """停止后台写入任务，并写入队列中剩余的日志（应用关闭时调用）"""
+    global _flusher_task
+    if _flusher_task is not None and not _flusher_task.done():
+        # 停止信号排在已入队的日志之后
+        _queue.put_nowait(_STOP)
+        await _flusher_task
+    _flusher_task = None
+
+    batch = _drain()
+    if batch:
+        try:
+            await _write_batch(batch)
+        except Exception as e:
+            logger.error("[日志队列] 关闭时推送 %d 条日志通知失败: %s", len(batch), e)